@@ -0,0 +1,73 @@
+"""Startup benchmark of loading Mind2Web splits from json vs. the binary cache in `utils/data.py`.
+
+For each split, times parsing the json shards, writing their cache, and loading
+the cache (best of `--repeat`), and checks that both loads give the same samples.
+"""
+
+import os
+import json
+import time
+import argparse
+from utils.data import get_data_paths, get_cache_path, load_shard
+
+
+def timeit(func, repeat: int) -> tuple[float, object]:
+    """Return the best wall time (s) over `repeat` runs, and the last result."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def load_split_json(data_paths: list[str]) -> list[dict]:
+    samples = []
+    for data_path in data_paths:
+        with open(data_path, "r") as f:
+            samples.extend(json.load(f))
+    return samples
+
+
+def load_split_cache(data_paths: list[str]) -> list[dict]:
+    samples = []
+    for data_path in data_paths:
+        samples.extend(load_shard(data_path, args.cache_dir))
+    return samples
+
+
+def main():
+    for split in args.splits:
+        if not os.path.isdir(os.path.join(args.data_dir, split)):
+            print(f"Skipping split [{split}], not found under [{args.data_dir}]")
+            continue
+        data_paths = get_data_paths(args.data_dir, split)
+        cache_paths = [get_cache_path(p, args.cache_dir) for p in data_paths]
+        for path in cache_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+        json_time, json_samples = timeit(lambda: load_split_json(data_paths), args.repeat)
+        build_time, _ = timeit(lambda: load_split_cache(data_paths), 1)
+        cache_time, cache_samples = timeit(lambda: load_split_cache(data_paths), args.repeat)
+        assert cache_samples == json_samples, f"Cached samples of [{split}] differ"
+
+        json_mb = sum([os.path.getsize(p) for p in data_paths]) / 2**20
+        cache_mb = sum([os.path.getsize(p) for p in cache_paths]) / 2**20
+        print(f"{split} (#{len(json_samples)} samples, {json_mb:.1f}MB json, {cache_mb:.1f}MB cache)")
+        print(f"  json : {json_time:8.3f}s")
+        print(f"  build: {build_time:8.3f}s (one-time, json + cache write)")
+        print(f"  cache: {cache_time:8.3f}s ({json_time / cache_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, default="data")
+    parser.add_argument("--splits", type=str, nargs="+",
+                        default=["test_task", "test_website", "test_domain", "train"])
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Defaults to `{data_dir}/cache`.")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,390 @@
+"""Micro-benchmarks for the observation functions in `utils/env.py` on synthetic DOMs.
+
+Runs offline. `functions` reports latency percentiles, python allocations, and
+peak RSS per function; `paths` compares previous and current implementations.
+Save results with `--output` and compare two runs with `--baseline`.
+"""
+
+import json
+import time
+import random
+import resource
+import argparse
+import tracemalloc
+import numpy as np
+from lxml import etree
+from utils.env import (
+    NodeIndex, StepTrees, prune_tree, get_nodes_to_keep, get_tree_repr,
+    get_pruned_tree_repr, get_target_obs, get_raw_target_obs,
+    META_ATTRIBUTES, compute_attribute_meta, stream_target_tree,
+    get_top_k_obs, get_target_obs_and_act, build_step_obs,
+)
+
+
+# %% synthetic pages
+TAGS = ["div", "span", "a", "button", "input", "li", "ul", "td", "tr", "p", "img", "label"]
+WORDS = [
+    "home", "search", "flights", "hotels", "book", "now", "menu", "item", "sign",
+    "in", "from", "to", "date", "price", "results", "next", "submit", "close",
+]
+ATTRS = ["class", "aria_label", "role", "type", "title", "value", "placeholder"]
+
+
+def make_dom(num_nodes: int, max_depth: int = 20, seed: int = 0) -> str:
+    """Generate a cleaned-html-like page with `num_nodes` elements."""
+    rng = random.Random(seed)
+    root = etree.Element("html", backend_node_id="0")
+    frontier = [(root, 0)]
+    for node_id in range(1, num_nodes):
+        # mostly extend recent nodes to get deep, bushy subtrees like real pages
+        parent, depth = rng.choice(frontier[-32:] if rng.random() < 0.8 else frontier)
+        if depth >= max_depth:
+            parent, depth = root, 0
+        if rng.random() < 0.3:
+            node = etree.SubElement(parent, "text")
+            node.text = " ".join(rng.choices(WORDS, k=rng.randint(1, 12)))
+            continue
+        node = etree.SubElement(parent, rng.choice(TAGS), backend_node_id=str(node_id))
+        for attr in rng.sample(ATTRS, rng.randint(0, 3)):
+            node.set(attr, " ".join(rng.choices(WORDS, k=rng.randint(1, 4))))
+        frontier.append((node, depth + 1))
+    return etree.tostring(root, encoding="unicode")
+
+
+def sample_candidates(dom_tree, num_candidates: int, seed: int = 0) -> list[str]:
+    node_ids = [n.get("backend_node_id") for n in dom_tree.iter() if n.get("backend_node_id")]
+    return random.Random(seed).sample(node_ids, min(num_candidates, len(node_ids)))
+
+
+def add_action_uid(dom_tree, seed: int = 0) -> str:
+    """Mark a random non-empty element as the ground-truth element of a raw_html step."""
+    nodes = [
+        n for n in dom_tree.iter()
+        if n.get("backend_node_id") and len(n) > 0 and n.getparent() is not None
+    ]
+    node = random.Random(seed).choice(nodes)
+    node.set("data_pw_testid_buckeye", "action-uid")
+    return "action-uid"
+
+
+def make_step(dom_tree, num_negatives: int, top_k: int, seed: int = 0) -> dict:
+    """Build a scored step on a page, with one positive candidate ranked within `top_k`."""
+    rng = random.Random(seed)
+    action_uid = add_action_uid(dom_tree, seed)
+    html = etree.tostring(dom_tree, encoding="unicode")
+    pos_id, *neg_ids = sample_candidates(dom_tree, num_negatives + 1, seed)
+    ranks = rng.sample(range(len(neg_ids) + 1), len(neg_ids) + 1)
+    pos_rank = rng.randrange(top_k)
+    return {
+        "cleaned_html": html,
+        "raw_html": html,
+        "action_uid": action_uid,
+        "operation": {"op": "CLICK", "value": ""},
+        "pos_candidates": [{"backend_node_id": pos_id, "rank": pos_rank}],
+        "neg_candidates": [
+            {"backend_node_id": c, "rank": r + (r >= pos_rank)}
+            for c, r in zip(neg_ids, ranks)
+        ],
+    }
+
+
+def timeit(func, repeat: int) -> float:
+    """Return the best wall time (ms) over `repeat` runs."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def measure(func, repeat: int) -> dict:
+    """Latency percentiles (ms) over `repeat` runs, and python allocations of one run."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    num_blocks = sum([stat.count for stat in tracemalloc.take_snapshot().statistics("filename")])
+    tracemalloc.stop()
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return {
+        "min": min(times), "mean": float(np.mean(times)),
+        "p50": float(p50), "p90": float(p90), "p99": float(p99),
+        "alloc_peak_kb": peak / 1024, "alloc_blocks": num_blocks,
+    }
+
+
+def get_peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# %% function benchmarks
+def bench_functions(step: dict, candidates: list[str], top_k: int, repeat: int) -> dict:
+    """Measure each observation function in isolation on one synthetic step."""
+    dom_tree = etree.fromstring(step["cleaned_html"])
+    pruned_tree = prune_tree(dom_tree, candidates)
+    raw_step = dict(step, pos_candidates=[])
+    functions = {
+        "parse": lambda: etree.fromstring(step["cleaned_html"]),
+        "prune_tree": lambda: prune_tree(dom_tree, candidates),
+        "get_tree_repr": lambda: get_tree_repr(
+            pruned_tree, id_mapping={}, keep_html_brackets=True
+        ),
+        "get_pruned_tree_repr": lambda: get_pruned_tree_repr(
+            dom_tree, candidates, keep_html_brackets=True
+        ),
+        "get_top_k_obs": lambda: get_top_k_obs(step, top_k),
+        "get_target_obs_and_act": lambda: get_target_obs_and_act(step),
+        "get_target_obs_and_act[raw]": lambda: get_target_obs_and_act(raw_step),
+        "build_step_obs": lambda: build_step_obs(step, top_k, previous_top_k=3),
+    }
+    results = {}
+    for name, func in functions.items():
+        results[name] = measure(func, repeat)
+        results[name]["peak_rss_mb"] = get_peak_rss_mb()
+    return results
+
+
+def report_functions(num_nodes: int, results: dict, baseline: dict = None):
+    for name, stats in results.items():
+        line = (
+            f"#nodes={num_nodes:>7} | {name:<28} | p50 {stats['p50']:9.2f}ms | "
+            f"p90 {stats['p90']:9.2f}ms | p99 {stats['p99']:9.2f}ms | "
+            f"alloc {stats['alloc_peak_kb']:9.1f}KB | rss {stats['peak_rss_mb']:7.1f}MB"
+        )
+        if baseline is not None and name in baseline:
+            line += f" | vs baseline p50: {baseline[name]['p50'] / stats['p50']:.2f}x"
+        print(line)
+
+
+# %% path comparisons
+def bench_prune_lookup(dom_tree, candidates: list[str], repeat: int) -> dict:
+    """Compare per-candidate full-tree xpath lookups against a `NodeIndex`."""
+    def xpath_lookup():
+        for c in candidates:
+            dom_tree.xpath(f'//*[@backend_node_id="{c}"]')[0]
+
+    def index_lookup():
+        index = NodeIndex(dom_tree)
+        for c in candidates:
+            index.get_node(c)
+
+    def keep_set():
+        get_nodes_to_keep(dom_tree, candidates)
+
+    def prune():
+        prune_tree(dom_tree, candidates)
+
+    return {
+        "xpath_lookup": timeit(xpath_lookup, repeat),
+        "index_lookup": timeit(index_lookup, repeat),
+        "nodes_to_keep": timeit(keep_set, repeat),
+        "prune_tree": timeit(prune, repeat),
+    }
+
+
+def bench_prune_repr(dom_tree, candidates: list[str], repeat: int) -> dict:
+    """Compare copying prune + repr against `get_pruned_tree_repr`, with and
+    without emitting the compact tokens directly."""
+    index = NodeIndex(dom_tree)
+
+    def copy_prune_repr():
+        pruned_tree = prune_tree(dom_tree, candidates, index=index)
+        return get_tree_repr(pruned_tree, id_mapping={}, keep_html_brackets=True)[0]
+
+    def single_pass_repr():
+        return get_pruned_tree_repr(
+            dom_tree, candidates, keep_html_brackets=True, index=index,
+            emit_tokens=False,
+        )
+
+    def token_repr():
+        return get_pruned_tree_repr(
+            dom_tree, candidates, keep_html_brackets=True, index=index,
+        )
+
+    assert copy_prune_repr() == single_pass_repr() == token_repr()
+    return {
+        "copy_prune_repr": timeit(copy_prune_repr, repeat),
+        "single_pass_repr": timeit(single_pass_repr, repeat),
+        "token_repr": timeit(token_repr, repeat),
+    }
+
+
+def match_target_tags(raw_obs: str, element_id: str) -> str:
+    """Previous raw_html fallback: cut the target element out of the full repr
+    by balancing its open and close tags."""
+    start_idx = raw_obs.find(f"id={element_id}")
+    start_tag_idx = raw_obs.rfind("<", 0, start_idx)
+    end_tag_idx = raw_obs.find(">", start_idx)
+    tag_name = raw_obs[start_tag_idx + 1 : end_tag_idx].split()[0]
+    open_count, close_count = 0, 0
+    search_idx = start_tag_idx
+    while True:
+        next_open_tag = raw_obs.find(f"<{tag_name}", search_idx)
+        next_close_tag = raw_obs.find(f"</{tag_name}>", search_idx)
+        if next_open_tag == -1 and next_close_tag == -1:
+            break
+        if next_open_tag != -1 and (
+            next_open_tag < next_close_tag or next_close_tag == -1
+        ):
+            open_count += 1
+            search_idx = raw_obs.find(">", next_open_tag) + 1
+        else:
+            close_count += 1
+            search_idx = next_close_tag + len(f"</{tag_name}>")
+        if open_count == close_count:
+            break
+    return raw_obs[start_tag_idx:search_idx]
+
+
+def bench_raw_target(raw_html: str, action_uid: str, repeat: int) -> dict:
+    """Compare tag matching over the full raw repr against subtree extraction."""
+    step = {"raw_html": raw_html, "action_uid": action_uid}
+    trees = StepTrees(step)
+    dom_tree, index = trees.get("raw_html"), trees.get_index("raw_html")
+    element_id = index.get_action_node(action_uid).get("backend_node_id")
+
+    def tag_matching():
+        return match_target_tags(get_target_obs(dom_tree, [element_id], index), element_id)
+
+    def subtree():
+        trees.raw_target = None  # not cached across runs
+        return get_raw_target_obs(step, trees)[1]
+
+    assert tag_matching() == subtree()
+    return {
+        "tag_matching": timeit(tag_matching, repeat),
+        "subtree": timeit(subtree, repeat),
+    }
+
+
+def bench_raw_stream(raw_html: str, action_uid: str, repeat: int) -> dict:
+    """Compare parsing the full raw page against streaming the target's part of it."""
+    def full_parse():
+        trees = StepTrees({"raw_html": raw_html, "action_uid": action_uid})
+        trees.get_index("raw_html")
+        return get_raw_target_obs(trees.step, trees)
+
+    def stream():
+        dom_tree, gt_element = stream_target_tree(raw_html, action_uid)
+        element_id = gt_element.get("backend_node_id")
+        return element_id, get_pruned_tree_repr(
+            dom_tree, [element_id], keep_html_brackets=True,
+            index=NodeIndex(dom_tree), root=gt_element,
+        )
+
+    assert full_parse() == stream()
+    return {"full_parse": timeit(full_parse, repeat), "stream": timeit(stream, repeat)}
+
+
+def bench_attribute_meta(dom_tree, repeat: int) -> dict:
+    """Compare building the meta of every element against the cached lookup."""
+    values = [
+        tuple([n.get(attr) for attr in META_ATTRIBUTES])
+        for n in dom_tree.iter(tag=etree.Element)
+    ]
+
+    def uncached_meta():
+        for v in values:
+            compute_attribute_meta.__wrapped__(v)
+
+    def cached_meta():
+        for v in values:
+            compute_attribute_meta(v)
+
+    def cold_cached_meta():
+        compute_attribute_meta.cache_clear()
+        cached_meta()
+
+    results = {
+        "uncached_meta": timeit(uncached_meta, repeat),
+        "cold_cached_meta": timeit(cold_cached_meta, repeat),
+    }
+    info = compute_attribute_meta.cache_info()
+    results["cached_meta"] = timeit(cached_meta, repeat)
+    print(f"attribute meta cache: {info.hits / (info.hits + info.misses):.1%} hits on one page")
+    return results
+
+
+def report(num_nodes: int, results: dict, base: str, new: str):
+    speedup = results[base] / results[new]
+    print(
+        f"#nodes={num_nodes:>7} | " +
+        " | ".join([f"{k}: {v:8.2f}ms" for k, v in results.items()]) +
+        f" | speedup: {speedup:.1f}x"
+    )
+
+
+def run_paths(dom_tree, candidates: list[str], num_nodes: int) -> dict:
+    results = {}
+    results["prune_lookup"] = bench_prune_lookup(dom_tree, candidates, args.repeat)
+    report(num_nodes, results["prune_lookup"], "xpath_lookup", "index_lookup")
+    results["prune_repr"] = bench_prune_repr(dom_tree, candidates, args.repeat)
+    report(num_nodes, results["prune_repr"], "copy_prune_repr", "token_repr")
+    action_uid = add_action_uid(dom_tree)
+    raw_html = etree.tostring(dom_tree, encoding="unicode")
+    results["raw_target"] = bench_raw_target(raw_html, action_uid, args.repeat)
+    report(num_nodes, results["raw_target"], "tag_matching", "subtree")
+    results["raw_stream"] = bench_raw_stream(raw_html, action_uid, args.repeat)
+    report(num_nodes, results["raw_stream"], "full_parse", "stream")
+    results["attribute_meta"] = bench_attribute_meta(dom_tree, args.repeat)
+    report(num_nodes, results["attribute_meta"], "uncached_meta", "cached_meta")
+    return results
+
+
+def main():
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = {r["num_nodes"]: r for r in json.load(f)["results"]}
+
+    results = []
+    for num_nodes in args.sizes:
+        dom_tree = etree.fromstring(make_dom(num_nodes, args.max_depth))
+        candidates = sample_candidates(dom_tree, args.num_candidates)
+        size_results = {"num_nodes": num_nodes}
+        if "functions" in args.benchmarks:
+            step = make_step(dom_tree, args.num_negatives, args.top_k)
+            size_results["functions"] = bench_functions(
+                step, candidates, args.top_k, args.repeat
+            )
+            report_functions(
+                num_nodes, size_results["functions"],
+                baseline.get(num_nodes, {}).get("functions"),
+            )
+        if "paths" in args.benchmarks:
+            size_results["paths"] = run_paths(dom_tree, candidates, num_nodes)
+        size_results["peak_rss_mb"] = get_peak_rss_mb()
+        results.append(size_results)
+
+    if args.output is not None:
+        with open(args.output, "w") as fw:
+            json.dump({"config": vars(args), "results": results}, fw, indent=2)
+        print(f"Saved results to [{args.output}]")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 50000, 200000])
+    parser.add_argument("--num_candidates", type=int, default=9,
+                        help="Candidates pruned per step (target + previous + current top-k).")
+    parser.add_argument("--num_negatives", type=int, default=200,
+                        help="Scored negative candidates per synthetic step.")
+    parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument("--max_depth", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--benchmarks", type=str, nargs="+",
+                        default=["functions", "paths"], choices=["functions", "paths"])
+    parser.add_argument("--output", type=str, default=None,
+                        help="Json file to save the results to.")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Json results of a previous run to compare against.")
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,57 @@
+"""Complete an OpenAI Batch API input file locally from recorded responses.
+
+Stands in for the Batch API to test `run_mind2web.py --batch` offline: each
+request is answered from a `--llm_backend record` log (see `ResponseLog`),
+and written as a line of a batch output file; unrecorded requests get an error.
+"""
+
+import json
+import argparse
+from utils.cache import get_response_key
+from utils.llm import ResponseLog
+
+
+def complete_request(request: dict, response_log: ResponseLog) -> dict:
+    """Answer a batch input line in the format of a batch output line."""
+    body = request["body"]
+    key = get_response_key(body["model"], body["messages"], body["temperature"], body.get("stop"))
+    result = {"id": f"batch_req_{key}", "custom_id": request["custom_id"]}
+    try:
+        message, info = response_log.replay(key)
+    except KeyError as e:
+        return {**result, "response": None, "error": {"code": "not_recorded", "message": str(e)}}
+    return {**result, "error": None, "response": {
+        "status_code": 200,
+        "request_id": key,
+        "body": {
+            "object": "chat.completion",
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": message},
+                "finish_reason": "stop",
+            }],
+            "usage": info,
+        },
+    }}
+
+
+def main():
+    response_log = ResponseLog(args.llm_log_path, "replay", args.simulate_latency)
+    with open(args.input_path, "r") as f, open(args.output_path, "w") as fw:
+        for line in f:
+            result = complete_request(json.loads(line), response_log)
+            fw.write(json.dumps(result) + "\n")
+    print(f"Completed #{response_log.hits} requests, #{response_log.misses} not recorded")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_path", type=str, default="results/batch_input.jsonl")
+    parser.add_argument("--output_path", type=str, default="results/batch_output.jsonl")
+    parser.add_argument("--llm_log_path", type=str, default="results/responses.jsonl",
+                        help="Jsonl file of recorded responses.")
+    parser.add_argument("--simulate_latency", action="store_true")
+    args = parser.parse_args()
+
+    main()
@@ -3,6 +3,7 @@ import numpy as np
 from pathlib import Path
 from openai import BadRequestError
 from utils.env import *
+from utils.store import get_step_key
 from utils.llm import (
     generate_response, num_tokens_from_messages,
     MAX_TOKENS, extract_from_response,
@@ -40,84 +41,149 @@ def get_exemplars(args) -> list:
     return memory
 
 
-def eval_sample(task_id, args, sample):
-    # initialize metrics
-    element_acc, action_f1, step_success, success = [], [], [], []
-    token_stats = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-    conversation = []
-    episode_length = len(sample["action_reprs"])
+def build_query(task: str, prev_obs: list[str], prev_actions: list[str], obs: str) -> list:
+    """Build the trajectory query from previous observations and actions."""
+    query = []
+    for o, a in zip(prev_obs, prev_actions):
+        if len(query) == 0:
+            query.append({
+                "role": "user",
+                "content": f"Task: {task}\nTrajectory:\n" + o,
+            })
+        else:
+            query.append({"role": "user", "content": o})
+        query.append({"role": "assistant", "content": a})
 
-    exemplars = get_exemplars(args)
-    # print(exemplars)
+    if len(query) == 0:
+        query.append({
+            "role": "user",
+            "content": f"Task: {task}\nTrajectory:\n"
+            + "Observation: `" + obs + "`",
+        })
+    else:
+        query.append({"role": "user", "content": "Observation: `" + obs + "`"})
+    return query
 
-    sys_message = [
-        {
-            "role": "system",
-            "content": "You are a large language model trained to navigate the web. Output the next action and wait for the next observation. Here is the action space:\n1. `CLICK [id]`: Click on an HTML element with its id.\n2. `TYPE [id] [value]`: Type a string into the element with the id.\n3. `SELECT [id] [value]`: Select a value for an HTML element by its id.",
-        }
-    ]
 
+ELIDED_OBS = "Observation: `(omitted)`"
+# (max_value_length, max_length) of attributes and texts, tried in order
+REDUCED_LENGTHS = [(3, 10), (2, 5), (1, 2)]
+
+
+def fit_query(s, sample, obs, prev_obs, prev_actions, sys_message, args):
+    """Shrink the observations of a step until its query fits in the context limit.
+
+    Lowers the number of candidates in the current observation first, then
+    elides history observations from the oldest, then shortens attribute and
+    text lengths. Returns the query, or None if it still does not fit.
+    """
+    task, max_tokens = sample["confirmed_task"], MAX_TOKENS[args.model]
+    trees = StepTrees(s)
+
+    def fits(obs, history):
+        query = build_query(task, history, prev_actions, obs)
+        if num_tokens_from_messages(sys_message + query, args.model) <= max_tokens:
+            return query
+        return None
+
+    for top_k in range(args.top_k_elements - 1, 0, -1):
+        obs, _ = get_top_k_obs(s, top_k, use_raw=False, trees=trees)
+        query = fits(obs, prev_obs)
+        if query is not None:
+            logger.info(f"Fit the context limit with {top_k} candidates")
+            return query
+
+    history = list(prev_obs)
+    for i in range(len(history)):
+        history[i] = ELIDED_OBS
+        query = fits(obs, history)
+        if query is not None:
+            logger.info(f"Fit the context limit by eliding {i + 1} history observations")
+            return query
+
+    for max_value_length, max_length in REDUCED_LENGTHS:
+        obs, _ = get_top_k_obs(
+            s, 1, use_raw=False, trees=trees,
+            max_value_length=max_value_length, max_length=max_length,
+        )
+        query = fits(obs, history)
+        if query is not None:
+            logger.info(f"Fit the context limit with attribute lengths {max_value_length}/{max_length}")
+            return query
+    return None
+
+
+SYS_MESSAGE = [
+    {
+        "role": "system",
+        "content": "You are a large language model trained to navigate the web. Output the next action and wait for the next observation. Here is the action space:\n1. `CLICK [id]`: Click on an HTML element with its id.\n2. `TYPE [id] [value]`: Type a string into the element with the id.\n3. `SELECT [id] [value]`: Select a value for an HTML element by its id.",
+    }
+]
+STOP_TOKENS = ["Task:", "obs:"]
+EMPTY_TOKEN_STATS = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+def iter_step_requests(args, sample, exemplars: list, obs_store=None, covered=()):
+    """Yield the request of each step of a sample, in order.
+
+    Each request has the step's `target_act` and `pos_ids`, and either the
+    `messages` to query the model with, or the `log` entry of a step failed
+    without querying (ground truth not in the cleaned html, or over the context
+    limit). Evaluation is teacher-forced, so requests do not depend on earlier
+    predictions, except that steps in `covered` (checked lazily, e.g., steps
+    acted on by an earlier workflow call) get neither.
+    """
+    sys_message = SYS_MESSAGE
     prev_actions, prev_obs = [], []
-    previous_k = 5
 
-    for s, act_repr in zip(sample["actions"], sample["action_reprs"]):
-        _, target_act = get_target_obs_and_act(s)
+    for i, (s, act_repr) in enumerate(zip(sample["actions"], sample["action_reprs"])):
+        # get query, obs, act, precomputed if available
+        step_obs = None
+        if obs_store is not None:
+            step_obs = obs_store.get(get_step_key(sample, s))
+        if step_obs is None:
+            step_obs = build_step_obs(
+                s, args.top_k_elements, args.previous_top_k_elements
+            )
+        target_act, target_obs = step_obs["target_act"], step_obs["target_obs"]
+        pos_ids = [c["backend_node_id"] for c in s["pos_candidates"]][:1]
+        request = {"target_act": target_act, "pos_ids": pos_ids}
+        history = (list(prev_obs), list(prev_actions))
+        prev_obs.append("Observation: `" + target_obs + "`")
+        prev_actions.append("Action: `" + target_act + "` (" + act_repr + ")")
+
         pos_candidates = [
             c for c in s["pos_candidates"] if c["rank"] < args.top_k_elements
         ]
+        if i in covered:
+            yield request
+            continue
 
-        # get query, obs, act
-        target_obs, _ = get_top_k_obs(s, args.previous_top_k_elements)
         # Continue next loop if the ground truth element is not in the cleaned html
         if len(pos_candidates) == 0:
-            element_acc.append(0)
-            action_f1.append(0)
-            step_success.append(0)
-            prev_obs.append("Observation: `" + target_obs + "`")
-            prev_actions.append("Action: `" + target_act + "` (" + act_repr + ")")
-            conversation.append("The ground truth element is not in cleaned html")
+            request["log"] = "The ground truth element is not in cleaned html"
+            yield request
             continue
 
         # construct query
-        query = []
-        for o, a in zip(prev_obs, prev_actions):
-            if len(query) == 0:
-                query.append({
-                    "role": "user",
-                    "content": f"Task: {sample['confirmed_task']}\nTrajectory:\n" + o,
-                })
-            else:
-                query.append({"role": "user", "content": o})
-            query.append({"role": "assistant", "content": a})
-        
-        obs, _ = get_top_k_obs(s, args.top_k_elements, use_raw=False)
-        if len(query) == 0:
-            query.append({
-                "role": "user",
-                "content": f"Task: {sample['confirmed_task']}\nTrajectory:\n"
-                + "Observation: `" + obs + "`",
-            })
-        else:
-            query.append({"role": "user", "content": "Observation: `" + obs + "`"})
-        
-        prev_obs.append("Observation: `" + target_obs + "`")
-        prev_actions.append("Action: `" + target_act + "` (" + act_repr + ")")
-        
-        # token limit
+        query = build_query(sample["confirmed_task"], *history, step_obs["obs"])
         total_num_tokens = num_tokens_from_messages(sys_message + query, args.model)
+        if total_num_tokens > MAX_TOKENS[args.model] and args.adaptive_obs:
+            query = fit_query(
+                s, sample, step_obs["obs"], *history, sys_message, args,
+            ) or query
+            total_num_tokens = num_tokens_from_messages(sys_message + query, args.model)
+
+        # token limit
         if total_num_tokens > MAX_TOKENS[args.model]:
             logger.info(
                 f"Too many tokens in acting ({total_num_tokens} / {MAX_TOKENS[args.model]}), skipping..."
             )
-            element_acc.append(0)
-            action_f1.append(0)
-            step_success.append(0)
-            conversation.append(
-                {
-                    "input": sys_message + query,
-                    "output": f"FAILED DUE TO THE CONTEXT LIMIT: {total_num_tokens}",
-                }
-            )
+            request["log"] = {
+                "input": sys_message + query,
+                "output": f"FAILED DUE TO THE CONTEXT LIMIT: {total_num_tokens}",
+            }
+            yield request
             continue
 
         # message
@@ -134,45 +200,83 @@ def eval_sample(task_id, args, sample):
             else:
                 demo_message.extend(e)
 
-        message = sys_message + demo_message + query
-        try:
-            response, info = generate_response(
-                messages=message,
-                model=args.model,
-                temperature=args.temperature,
-                stop_tokens=["Task:", "obs:"],
+        request["messages"] = sys_message + demo_message + query
+        yield request
+
+
+def eval_sample(task_id, args, sample, obs_store=None, responses=None):
+    """Evaluate a sample, querying the model at each step, or taking the
+    responses of a completed batch if given (see `load_batch_responses`)."""
+    # initialize metrics
+    element_acc, action_f1, step_success, success = [], [], [], []
+    token_stats = dict(EMPTY_TOKEN_STATS)
+    conversation = []
+    episode_length = len(sample["action_reprs"])
+
+    exemplars = get_exemplars(args)
+    # print(exemplars)
+
+    workflow_acts = {}  # step index -> action expanded from an earlier workflow call
+    requests = iter_step_requests(args, sample, exemplars, obs_store, covered=workflow_acts)
+
+    for i, request in enumerate(requests):
+        target_act, pos_ids = request["target_act"], request["pos_ids"]
+
+        # Score the action of a workflow call covering this step, without querying
+        if i in workflow_acts:
+            pred_act = workflow_acts[i]
+            conversation.append({"pred_act": pred_act, "target_act": target_act})
+            for metric, value in zip(
+                [element_acc, action_f1, step_success],
+                get_step_metrics(pred_act, target_act, pos_ids),
+            ):
+                metric.append(value)
+            continue
+
+        # Failed without querying, see `iter_step_requests`
+        if "log" in request:
+            element_acc.append(0)
+            action_f1.append(0)
+            step_success.append(0)
+            conversation.append(request["log"])
+            continue
+
+        message = request["messages"]
+        if responses is not None:
+            message, response, info = responses.get(
+                get_batch_custom_id(task_id, i), (message, "", dict(EMPTY_TOKEN_STATS))
             )
-        except BadRequestError:
-            response = ""
-            info = {
-                "prompt_tokens": 0,
-                "completion_tokens": 0,
-                "total_tokens": 0,
-            }
+        else:
+            try:
+                response, info = generate_response(
+                    messages=message,
+                    model=args.model,
+                    temperature=args.temperature,
+                    stop_tokens=STOP_TOKENS,
+                )
+            except BadRequestError:
+                response = ""
+                info = dict(EMPTY_TOKEN_STATS)
         conversation.append({"input": message, "output": response, "token_stats": info})
         for k, v in info.items():
-            token_stats[k] += v
+            token_stats[k] = token_stats.get(k, 0) + v
         pred_act = extract_from_response(response, "`")
-        pred_op, pred_id, pred_val = parse_act_str(pred_act)
-        target_op, _, target_val = parse_act_str(target_act)
+        if args.mode == "action":
+            # a workflow call acts on this and the following steps
+            pred_acts = expand_act_str(
+                pred_act, sample["actions"][i:], args.workflow_code_path
+            )[: episode_length - i]
+            pred_act = pred_acts[0]
+            for j, act in enumerate(pred_acts[1:], start=i + 1):
+                workflow_acts[j] = act
 
         # calculate metrics
-        pos_ids = [c["backend_node_id"] for c in s["pos_candidates"]][:1]
-        if pred_id in pos_ids:
-            element_acc.append(1)
-        else:
-            element_acc.append(0)
-        action_f1.append(
-            calculate_f1(
-                construct_act_str(pred_op, pred_val),
-                construct_act_str(target_op, target_val),
-            )
-        )
         conversation.append({"pred_act": pred_act, "target_act": target_act})
-        if pred_act == target_act:
-            step_success.append(1)
-        else:
-            step_success.append(0)
+        for metric, value in zip(
+            [element_acc, action_f1, step_success],
+            get_step_metrics(pred_act, target_act, pos_ids),
+        ):
+            metric.append(value)
 
     # check the last episode_length of step_success, if all 1, then success = 1
     if np.sum(step_success[-episode_length:]) == episode_length:
@@ -188,7 +292,68 @@ def eval_sample(task_id, args, sample):
             "success": success,
         }
     )
+    logger.info(f"Token stats of task {task_id}: {token_stats}")
     log_dir = Path(f"{args.log_dir}/{args.model}/{args.benchmark}/{args.website}/{args.suffix}")
     log_dir.mkdir(parents=True, exist_ok=True)
     with open(os.path.join(log_dir, f"{task_id}.json"), "w") as f:
         json.dump(conversation, f, indent=2)
+
+
+# %% batch mode
+def get_batch_custom_id(task_id, step_id: int) -> str:
+    return f"task-{task_id}-step-{step_id}"
+
+
+def write_batch_requests(task_id, args, sample, fw, obs_store=None) -> int:
+    """Write the query of every step of a sample as a line of an OpenAI Batch
+    API input file, and return the number of queries.
+
+    Steps that a workflow call may later act on (with `--mode action`) are
+    queried too; their responses are ignored when ingested.
+    """
+    exemplars = get_exemplars(args)
+    num_requests = 0
+    for i, request in enumerate(iter_step_requests(args, sample, exemplars, obs_store)):
+        if "messages" not in request:
+            continue
+        fw.write(json.dumps({
+            "custom_id": get_batch_custom_id(task_id, i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": args.model,
+                "messages": request["messages"],
+                "temperature": args.temperature,
+                "stop": STOP_TOKENS,
+            },
+        }) + "\n")
+        num_requests += 1
+    return num_requests
+
+
+def load_batch_responses(input_path: str, output_path: str) -> dict:
+    """Load the {custom_id: (messages, response, token_stats)} of a completed
+    batch. Failed or missing requests get an empty response, as failed
+    requests do in `eval_sample`."""
+    responses = {}
+    with open(input_path, "r") as f:
+        for line in f:
+            request = json.loads(line)
+            responses[request["custom_id"]] = (
+                request["body"]["messages"], "", dict(EMPTY_TOKEN_STATS)
+            )
+    num_failed = len(responses)
+    with open(output_path, "r") as f:
+        for line in f:
+            result = json.loads(line)
+            response = result.get("response")
+            if result.get("error") is not None or response is None or response["status_code"] != 200:
+                continue
+            body = response["body"]
+            info = {k: body["usage"][k] for k in EMPTY_TOKEN_STATS}
+            message = body["choices"][0]["message"]["content"] or ""
+            responses[result["custom_id"]] = (responses[result["custom_id"]][0], message, info)
+            num_failed -= 1
+    if num_failed:
+        logger.warning(f"{num_failed} / {len(responses)} batch requests have no response")
+    return responses
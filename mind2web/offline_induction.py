@@ -1,39 +1,37 @@
 """Induce Website-Specific Workflows Offline from Training Examples."""
 
 import os
-import json
-import pickle
 import argparse
-from utils.data import add_scores, format_examples, filter_workflows
-
-import openai
-openai.api_key = os.environ["OPENAI_API_KEY"]
-from openai import OpenAI
-client = OpenAI()
+from utils.data import (
+    add_scores, load_candidate_results, format_examples, filter_workflows,
+    load_data_index, write_data_index, load_indexed_samples,
+)
+from utils.llm import generate_response, ResponseLog, set_response_log
 
 # %% Data loading and processing
-def get_data_dict(paths: list[str]) -> dict:
-    """Create dict for examples in domain-subdomain-website hierarchy.
+def get_data_index(data_dir: str) -> dict:
+    """Load the index of the split at `data_dir` (see `write_data_index`),
+    building it first if missing or outdated."""
+    root_dir, split = os.path.split(os.path.normpath(data_dir))
+    index = load_data_index(root_dir, split)
+    if index is None:
+        print(f"Indexing data files of split [{split}]...")
+        write_data_index(root_dir, split)
+        index = load_data_index(root_dir, split)
+    return index
+
+def get_data_dict(index: dict) -> dict:
+    """Create dict for example counts in domain-subdomain-website hierarchy.
     Args:
-        paths: list[str], list of data path strings
+        index: dict, index of the data files
     Rets:
         data_dict: dict[str, dict], (domain, subdomain, website) dict
     """
-    print("Start loading data files...")
     data_dict = {}
-    for p in paths:
-        print(p)
-        data = json.load(open(p, 'r'))
-        for ex in data:
-            domain, subdomain, website = ex["domain"], ex["subdomain"], ex["website"]
-            if domain not in data_dict:
-                data_dict[domain] = {}
-            if subdomain not in data_dict[domain]:
-                data_dict[domain][subdomain] = {}
-            if website not in data_dict[domain][subdomain]:
-                data_dict[domain][subdomain][website] = []
-            data_dict[domain][subdomain][website].append(ex)
-    print(f"Finished loading {len(paths)} files!")
+    for entry in index["samples"]:
+        domain, subdomain, website = entry["domain"], entry["subdomain"], entry["website"]
+        websites = data_dict.setdefault(domain, {}).setdefault(subdomain, {})
+        websites[website] = websites.get(website, 0) + 1
     return data_dict
 
 def get_split(data_dict: dict) -> dict:
@@ -44,10 +42,12 @@ def get_split(data_dict: dict) -> dict:
         split = input(f"Select from {options} >> ")
     return split, data_dict[split]
 
-def get_examples(data_dict: dict, tags: tuple[str, str, str]) -> list[dict]:
-    """Return the examples satisfying the tags."""
+def get_examples(data_dir: str, index: dict, tags: tuple[str, str, str]) -> list[dict]:
+    """Return the examples satisfying the tags, loading only those."""
     domain, subdomain, website = tags
-    return data_dict[domain][subdomain][website]
+    return load_indexed_samples(
+        data_dir, index, domain=domain, subdomain=subdomain, website=website
+    )
 
 
 # %% Prompt and generate
@@ -57,13 +57,12 @@ def llm_generate(tags: tuple[str, str, str], examples: list[dict], args, verbose
     prompt += format_examples(examples, args.prefix, args.suffix)
     prompt = '\n\n'.join([args.INSTRUCTION, args.ONE_SHOT, prompt])
     if verbose: print("Prompt:\n", prompt, '\n\n')
-    response = client.chat.completions.create(
-            model=args.model_name,
+    response, _ = generate_response(
             messages=[{"role": "user", "content": prompt}],
+            model=args.model_name,
             temperature=args.temperature,
             max_tokens=1024,
     )
-    response = response.choices[0].message.content
     if verbose: print(response)
     return response
 
@@ -79,13 +78,16 @@ def save_to_txt(text: str, args):
 
 # %% Main pipeline
 def main():
-    # load data into dict
-    data_paths = [os.path.join(args.data_dir, f) for f in os.listdir(args.data_dir)]
-    data_dict = get_data_dict(paths=data_paths)
+    if args.llm_backend != "api":
+        set_response_log(ResponseLog(args.llm_log_path, args.llm_backend, args.simulate_latency))
+    # index data into dict, examples are loaded per website
+    index = get_data_index(args.data_dir)
+    data_dict = get_data_dict(index)
 
     # load candidate scores and ranks
-    with open(os.path.join("data", "scores_all_data.pkl"), "rb") as f:
-        candidate_results = pickle.load(f)
+    candidate_results = load_candidate_results(
+        os.path.join("data", "scores_all_data.pkl"), os.path.join("data", "scores")
+    )
 
     # load prompt contexts
     args.INSTRUCTION = open(args.instruction_path, 'r').read()
@@ -93,7 +95,7 @@ def main():
 
     def single_website_loop(tags: tuple[str, str, str]):
         """Pipeline to induce, filter, and save workflows on a single website."""
-        examples = get_examples(data_dict, tags=tags)
+        examples = get_examples(args.data_dir, index, tags=tags)
         print(f"Split {tags} with #{len(examples)} examples")
         add_scores(examples, candidate_results)
         response = llm_generate(tags, examples, args)
@@ -108,7 +110,7 @@ def main():
             # select split
             args.domain, domain_dict = get_split(data_dict)
             args.subdomain, subdomain_dict = get_split(domain_dict)
-            args.website, examples = get_split(subdomain_dict)
+            args.website, _ = get_split(subdomain_dict)
 
             # generate workflows
             tags = [args.domain, args.subdomain, args.website]
@@ -140,6 +142,13 @@ if __name__ == "__main__":
     # model
     parser.add_argument("--model_name", type=str, default="gpt-4o")
     parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--llm_backend", type=str, default="api",
+                        choices=["api", "record", "replay"],
+                        help="Query the API, also record its responses, or replay recorded ones offline.")
+    parser.add_argument("--llm_log_path", type=str, default="results/responses.jsonl",
+                        help="Jsonl file of recorded responses.")
+    parser.add_argument("--simulate_latency", action="store_true",
+                        help="In replay, wait for latencies sampled from the recorded ones.")
 
     # prompt
     parser.add_argument("--instruction_path", type=str, default="prompt/instruction_action.txt")
@@ -4,11 +4,7 @@ import os
 import json
 import argparse
 from utils.data import load_json, format_examples, filter_workflows
-
-import openai
-openai.api_key = os.environ["OPENAI_API_KEY"]
-from openai import OpenAI
-client = OpenAI()
+from utils.llm import generate_response, ResponseLog, set_response_log
 
 
 def is_io_dict(item: dict | str) -> bool:
@@ -29,7 +25,9 @@ def get_trajectory(path: str):
 
 
 def main():
-    samples = load_json(args.data_dir, args.benchmark)
+    if args.llm_backend != "api":
+        set_response_log(ResponseLog(args.llm_log_path, args.llm_backend, args.simulate_latency))
+    samples = load_json(args.data_dir, args.benchmark, website=args.website)
     print(f"Loaded #{len(samples)} test examples")
     samples = [s for s in samples if s["website"] == args.website]
     print(f"Filtering down to #{len(samples)} examples on website [{args.website}]")
@@ -50,11 +48,11 @@ def main():
     ONE_SHOT = open(args.one_shot_path, 'r').read()
     domain, subdomain, website = samples[0]["domain"], samples[0]["subdomain"], samples[0]["website"]
     prompt = '\n\n'.join([INSTRUCTION, ONE_SHOT, f"Website: {domain}, {subdomain}, {website}\n{prompt}"])
-    response = client.chat.completions.create(
-            model=args.model_name,
+    response, _ = generate_response(
             messages=[{"role": "user", "content": prompt}],
-            temperature=args.temperature,
-    ).choices[0].message.content
+            model=args.model_name,
+            temperature=float(args.temperature),
+    )
     response = filter_workflows(response, args.website)
 
     # save to file
@@ -74,6 +72,13 @@ if __name__ == "__main__":
     # model
     parser.add_argument("--model_name", type=str, default="gpt-4o")
     parser.add_argument("--temperature", type=str, default=0.0)
+    parser.add_argument("--llm_backend", type=str, default="api",
+                        choices=["api", "record", "replay"],
+                        help="Query the API, also record its responses, or replay recorded ones offline.")
+    parser.add_argument("--llm_log_path", type=str, default="results/responses.jsonl",
+                        help="Jsonl file of recorded responses.")
+    parser.add_argument("--simulate_latency", action="store_true",
+                        help="In replay, wait for latencies sampled from the recorded ones.")
     # prompt
     parser.add_argument("--instruction_path", type=str, default="prompt/instruction_action.txt")
     parser.add_argument("--one_shot_path", type=str, default="prompt/one_shot_action.txt")
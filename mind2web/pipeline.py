@@ -4,6 +4,24 @@ import argparse
 import subprocess
 from utils.data import load_json
 
+def get_backend_args() -> list[str]:
+    """Record/replay arguments passed on to all scripts."""
+    backend_args = ['--llm_backend', args.llm_backend, '--llm_log_path', args.llm_log_path]
+    if args.simulate_latency:
+        backend_args.append('--simulate_latency')
+    return backend_args
+
+
+def get_client_args() -> list[str]:
+    """Client arguments passed on to `run_mind2web.py`."""
+    client_args = ['--max_retries', f'{args.max_retries}']
+    if args.rpm is not None:
+        client_args += ['--rpm', f'{args.rpm}']
+    if args.tpm is not None:
+        client_args += ['--tpm', f'{args.tpm}']
+    return client_args + get_backend_args()
+
+
 def offline():
     # workflow induction
     process = subprocess.Popen([
@@ -13,7 +31,7 @@ def offline():
         '--model', args.model, '--output_dir', "workflow",
         '--instruction_path', args.instruction_path,
         '--one_shot_path', args.one_shot_path,
-    ])
+    ] + get_backend_args())
     process.wait()
 
     # test inference
@@ -21,13 +39,13 @@ def offline():
         'python', 'run_mind2web.py',
         '--website', args.website,
         '--workflow_path', f"workflow/{args.website}.txt"
-    ])
+    ] + get_client_args())
     process.wait()
 
 
 def online():
     # load all examples for streaming
-    samples = load_json(args.data_dir, args.benchmark)
+    samples = load_json(args.data_dir, args.benchmark, website=args.website)
     print(f"Loaded #{len(samples)} test examples")
     if args.website is not None:
         samples = [s for s in samples if s["website"] == args.website]
@@ -45,7 +63,7 @@ def online():
             '--website', args.website, 
             '--start_idx', f'{i}', '--end_idx', f'{j}',
             '--domain', args.domain, '--subdomain', args.subdomain,
-        ])
+        ] + get_client_args())
         process.wait()
         print(f"Finished inference on {i}-{j} th example!\n")
 
@@ -56,7 +74,7 @@ def online():
                 '--website', args.website,
                 '--results_dir', args.results_dir,
                 '--output_path', args.workflow_path,
-            ])
+            ] + get_backend_args())
             process.wait()
             print(f"Finished workflow induction with 0-{i} th examples!\n")
 
@@ -84,6 +102,16 @@ if __name__ == "__main__":
     # gpt
     parser.add_argument("--model", type=str, default="gpt-4o")
     parser.add_argument("--temperature", type=str, default=0.0)
+    parser.add_argument("--max_retries", type=int, default=8)
+    parser.add_argument("--rpm", type=float, default=None,
+                        help="Requests per minute allowed to each inference run.")
+    parser.add_argument("--tpm", type=float, default=None,
+                        help="Tokens per minute allowed to each inference run.")
+    parser.add_argument("--llm_backend", type=str, default="api",
+                        choices=["api", "record", "replay"],
+                        help="Query the API, also record its responses, or replay recorded ones offline.")
+    parser.add_argument("--llm_log_path", type=str, default="results/responses.jsonl")
+    parser.add_argument("--simulate_latency", action="store_true")
 
     # induction frequency
     parser.add_argument("--induce_steps", type=int, default=1)
@@ -0,0 +1,58 @@
+"""Precompute Step Observations of a Benchmark Split into an Observation Store."""
+
+import argparse
+from tqdm import tqdm
+from utils.data import load_json, add_scores
+from utils.env import iter_step_obs, set_prune_cache
+from utils.cache import PruneCache
+from utils.store import write_store, get_step_key
+
+
+def iter_records(examples: list[dict]):
+    keys = [get_step_key(sample, s) for sample in examples for s in sample["actions"]]
+    steps = (s for sample in examples for s in sample["actions"])
+    records = iter_step_obs(
+        steps, args.top_k_elements, args.previous_top_k_elements,
+        num_workers=args.num_workers, chunksize=args.chunksize,
+    )
+    yield from zip(keys, tqdm(records, total=len(keys)))
+
+
+def main():
+    examples = load_json(args.data_dir, args.benchmark, website=args.website)
+    if args.website is not None:
+        examples = [s for s in examples if s["website"] == args.website]
+        print(f"Filtering down to #{len(examples)} examples on website [{args.website}]")
+    examples = add_scores(examples)  # add prediction scores and ranks to elements
+    if args.prune_cache_mb > 0:
+        set_prune_cache(PruneCache(args.prune_cache_mb * 2**20, args.prune_cache_path))
+
+    num_records = write_store(
+        iter_records(examples), args.store_dir, args.data_dir, args.benchmark,
+        args.top_k_elements, args.previous_top_k_elements, args.website,
+    )
+    print(f"Saved #{num_records} step observations to [{args.store_dir}]")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, default="data")
+    parser.add_argument("--benchmark", type=str, default="test_task",
+        choices=["test_task", "test_website", "test_domain", "train"])
+    parser.add_argument("--website", type=str, default=None)
+    parser.add_argument("--store_dir", type=str, default="data/obs_store")
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--prune_cache_mb", type=int, default=256,
+                        help="Memory for cached pruned observations (0 to disable).")
+    parser.add_argument("--prune_cache_path", type=str, default=None,
+                        help="Sqlite file to also keep cached observations on disk.")
+    parser.add_argument("--chunksize", type=int, default=4,
+                        help="Steps sent to a worker at a time.")
+
+    # env context, should match the evaluation run
+    parser.add_argument("--previous_top_k_elements", type=int, default=3)
+    parser.add_argument("--top_k_elements", type=int, default=5)
+
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,60 @@
+"""Convert Mind2Web Data Files into Formats that Load Faster."""
+
+import pickle
+import argparse
+from utils.data import write_score_store, write_data_index, get_data_paths, load_shard
+
+
+def prepare_scores():
+    with open(args.score_path, "rb") as f:
+        candidate_results = pickle.load(f)
+    num_samples = write_score_store(candidate_results, args.store_dir, args.score_path)
+    print(f"Saved scores of #{num_samples} samples to [{args.store_dir}]")
+
+
+def prepare_index():
+    for split in args.splits:
+        num_samples = write_data_index(args.data_dir, split, args.index_dir)
+        print(f"Indexed #{num_samples} samples of split [{split}]")
+
+
+def prepare_cache():
+    for split in args.splits:
+        data_paths = get_data_paths(args.data_dir, split)
+        num_samples = sum([len(load_shard(p, args.cache_dir)) for p in data_paths])
+        print(f"Cached #{num_samples} samples of split [{split}]")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # columnar candidate scores, read by `add_scores` when present
+    scores_parser = subparsers.add_parser("scores")
+    scores_parser.add_argument("--score_path", type=str, default="data/scores_all_data.pkl")
+    scores_parser.add_argument("--store_dir", type=str, default="data/scores")
+
+    # website index of each split, read by `load_json` to parse only one website
+    index_parser = subparsers.add_parser("index")
+    index_parser.add_argument("--data_dir", type=str, default="data")
+    index_parser.add_argument("--splits", type=str, nargs="+",
+        default=["test_task", "test_website", "test_domain", "train"])
+    index_parser.add_argument("--index_dir", type=str, default=None,
+        help="Defaults to `{data_dir}/index`.")
+
+    # binary cache of each shard, read by `load_json` and `get_data_dict`
+    cache_parser = subparsers.add_parser("cache")
+    cache_parser.add_argument("--data_dir", type=str, default="data")
+    cache_parser.add_argument("--splits", type=str, nargs="+",
+        default=["test_task", "test_website", "test_domain", "train"])
+    cache_parser.add_argument("--cache_dir", type=str, default=None,
+        help="Defaults to `{data_dir}/cache`.")
+
+    args = parser.parse_args()
+
+    if args.command == "scores":
+        prepare_scores()
+    elif args.command == "index":
+        prepare_index()
+    elif args.command == "cache":
+        prepare_cache()
@@ -0,0 +1,91 @@
+"""Recompute Step Metrics from Saved Conversation Logs, without Re-running Inference."""
+
+import os
+import json
+import argparse
+import functools
+import numpy as np
+from multiprocessing import Pool
+from utils.env import parse_act_str, get_step_metrics
+from results.calc_score import get_average
+
+
+def rescore_conversation(conversation: list) -> dict:
+    """Recompute the metrics of a `{task_id}.json` log written by `eval_sample`.
+
+    Each step is logged as either a skip note (ground truth not in the cleaned
+    html), a context-limit failure, or a `pred_act`/`target_act` pair; the
+    ground-truth element id is read from `target_act`.
+    """
+    element_acc, action_f1, step_success = [], [], []
+    for item in conversation[:-1]:
+        if isinstance(item, dict) and "pred_act" in item:
+            pos_ids = [parse_act_str(item["target_act"])[1]]
+            metrics = get_step_metrics(item["pred_act"], item["target_act"], pos_ids)
+        elif isinstance(item, str) or str(item.get("output", "")).startswith(
+            "FAILED DUE TO THE CONTEXT LIMIT"
+        ):
+            metrics = (0, 0, 0)
+        else:
+            continue
+        for metric, value in zip([element_acc, action_f1, step_success], metrics):
+            metric.append(value)
+
+    episode_length = len(step_success)
+    return {
+        "element_acc": element_acc,
+        "action_f1": action_f1,
+        "step_success": step_success,
+        "success": [int(np.sum(step_success) == episode_length)],
+    }
+
+
+def rescore_file(path: str, write: bool = False) -> tuple[str, bool, dict]:
+    conversation = json.load(open(path, "r"))
+    metrics = rescore_conversation(conversation)
+    changed = conversation[-1] != metrics
+    if changed and write:
+        conversation[-1] = metrics
+        with open(path, "w") as f:
+            json.dump(conversation, f, indent=2)
+    return path, changed, metrics
+
+
+def main():
+    file_paths = [
+        os.path.join(results_dir, f)
+        for results_dir in args.results_dirs
+        for f in sorted(os.listdir(results_dir)) if f.endswith(".json")
+    ]
+    with Pool(args.num_workers) as pool:
+        rescore = functools.partial(rescore_file, write=args.write)
+        results = pool.imap(rescore, file_paths, chunksize=args.chunksize)
+        dir_results = {}
+        for path, changed, metrics in results:
+            dir_results.setdefault(os.path.dirname(path), []).append((changed, metrics))
+
+    for results_dir, results in dir_results.items():
+        num_changed = sum([changed for changed, _ in results])
+        print(f"{results_dir} (#{len(results)} tasks, #{num_changed} changed)")
+        for name, key in [
+            ("Element Acc", "element_acc"), ("Action F1  ", "action_f1"),
+            ("Step SR    ", "step_success"), ("SR         ", "success"),
+        ]:
+            scores = [get_average(m[key]) for _, m in results if len(m[key])]
+            if len(scores) == 0:  # no task has a scored step
+                print(f"  {name}:   n/a")
+                continue
+            print(f"  {name}: {get_average(scores, True):5.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--results_dirs", type=str, nargs="+", required=True,
+                        help="Directories of `{task_id}.json` logs from `run_mind2web.py`.")
+    parser.add_argument("--write", action="store_true",
+                        help="Overwrite the metrics saved in the logs.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunksize", type=int, default=16)
+    args = parser.parse_args()
+
+    main()
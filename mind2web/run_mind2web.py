@@ -1,8 +1,13 @@
 import os
+import time
 import argparse
 from tqdm import tqdm
-from memory import eval_sample
-from utils.data import load_json, add_scores
+from memory import eval_sample, write_batch_requests, load_batch_responses
+from utils.data import load_json, load_lazy_samples, add_scores
+from utils.env import iter_step_obs, set_prune_cache
+from utils.cache import PruneCache, ResponseCache
+from utils.llm import configure_client, set_response_cache, ResponseLog, set_response_log
+from utils.store import open_store, get_step_key
 
 import logging
 logger = logging.getLogger("atm")
@@ -13,20 +18,90 @@ logger.addHandler(handler)
 
 
 def main():
-    examples = load_json(args.data_dir, args.benchmark)
+    configure_client(max_retries=args.max_retries, rpm=args.rpm, tpm=args.tpm)
+    if args.llm_backend != "api":
+        set_response_log(ResponseLog(args.llm_log_path, args.llm_backend, args.simulate_latency))
+    response_cache = None
+    if args.response_cache_path is not None:
+        response_cache = ResponseCache(args.response_cache_path, args.response_cache_mb * 2**20)
+        set_response_cache(response_cache)
+    if args.lazy_html:
+        examples = load_lazy_samples(args.data_dir, args.benchmark, website=args.website)
+    else:
+        examples = load_json(args.data_dir, args.benchmark, website=args.website)
     examples = [s for s in examples if s["website"] == args.website]
     print(f"Filtering down to #{len(examples)} examples on website [{args.website}]")
     examples = add_scores(examples) # add prediction scores and ranks to elements
 
+    # load precomputed observations, see `precompute_obs.py`
+    obs_store = open_store(
+        args.obs_store_dir, args.data_dir, args.benchmark,
+        args.top_k_elements, args.previous_top_k_elements, args.website,
+    )
+    if obs_store is not None:
+        print(f"Loaded #{len(obs_store)} precomputed step observations")
+
+    # cache pruned observations of pages shared across tasks
+    prune_cache = None
+    if args.prune_cache_mb > 0:
+        prune_cache = PruneCache(args.prune_cache_mb * 2**20, args.prune_cache_path)
+        set_prune_cache(prune_cache)
+
     if args.end_idx is None:
         args.end_idx = len(examples)
+
+    # otherwise build observations ahead of evaluation in a process pool
+    step_obs = None
+    if obs_store is None and args.num_workers > 1:
+        steps = (
+            s for sample in examples[args.start_idx: args.end_idx]
+            for s in sample["actions"]
+        )
+        step_obs = iter_step_obs(
+            steps, args.top_k_elements, args.previous_top_k_elements,
+            num_workers=args.num_workers,
+        )
+
+    # batch mode: write all step queries, or evaluate with their completed responses
+    batch_file, responses = None, None
+    if args.batch == "submit":
+        os.makedirs(os.path.dirname(args.batch_input_path) or ".", exist_ok=True)
+        batch_file, num_requests = open(args.batch_input_path, "w"), 0
+    elif args.batch == "ingest":
+        responses = load_batch_responses(args.batch_input_path, args.batch_output_path)
+
+    start_time = time.perf_counter()
     for i in tqdm(range(args.start_idx, args.end_idx)):
-        if args.mode == "memory":
-            eval_sample(i, args, examples[i])
-        elif args.mode == "action":
-            raise NotImplementedError
-        else:
+        sample_obs = obs_store
+        if step_obs is not None:
+            sample_obs = {
+                get_step_key(examples[i], s): next(step_obs)
+                for s in examples[i]["actions"]
+            }
+        if args.mode not in ["memory", "action"]:
             raise ValueError(f"Unsupported workflow format: {args.workflow_format}")
+        if batch_file is not None:
+            num_requests += write_batch_requests(i, args, examples[i], batch_file, sample_obs)
+        else:
+            eval_sample(i, args, examples[i], sample_obs, responses)
+
+    if batch_file is not None:
+        batch_file.close()
+        print(f"Wrote #{num_requests} batch requests to [{args.batch_input_path}]")
+
+    print(f"Evaluated #{args.end_idx - args.start_idx} tasks in {time.perf_counter() - start_time:.1f}s")
+
+    if prune_cache is not None:
+        # with a pool, observations are pruned on the workers' copies of the cache
+        if step_obs is None:
+            print(f"Prune cache: {prune_cache.hits} hits / {prune_cache.misses} misses")
+        prune_cache.close()
+    if response_cache is not None:
+        print(
+            f"Response cache: {response_cache.hits} hits / {response_cache.misses} misses, "
+            f"{response_cache.saved_prompt_tokens} prompt tokens saved"
+        )
+        response_cache.close()
 
 
 if __name__ == "__main__":
@@ -40,11 +115,44 @@ if __name__ == "__main__":
     # model
     parser.add_argument("--model", type=str, default="gpt-4")
     parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--max_retries", type=int, default=8,
+                        help="Retries of a request on rate limits and transient errors.")
+    parser.add_argument("--rpm", type=float, default=None,
+                        help="Client-side limit of requests per minute.")
+    parser.add_argument("--tpm", type=float, default=None,
+                        help="Client-side limit of tokens per minute.")
+    parser.add_argument("--llm_backend", type=str, default="api",
+                        choices=["api", "record", "replay"],
+                        help="Query the API, also record its responses, or replay recorded ones offline.")
+    parser.add_argument("--llm_log_path", type=str, default="results/responses.jsonl",
+                        help="Jsonl file of recorded responses.")
+    parser.add_argument("--simulate_latency", action="store_true",
+                        help="In replay, wait for latencies sampled from the recorded ones.")
+    parser.add_argument("--batch", type=str, default=None, choices=["submit", "ingest"],
+                        help="Write step queries as an OpenAI batch input file, or evaluate with its completed output file.")
+    parser.add_argument("--batch_input_path", type=str, default="results/batch_input.jsonl")
+    parser.add_argument("--batch_output_path", type=str, default="results/batch_output.jsonl")
+    parser.add_argument("--response_cache_path", type=str, default=None,
+                        help="Sqlite file to cache model responses in, and answer repeated requests from.")
+    parser.add_argument("--response_cache_mb", type=int, default=1024,
+                        help="Size limit of the response cache, evicting least recently used.")
 
     # env context
     parser.add_argument("--previous_top_k_elements", type=int, default=3)
     parser.add_argument("--top_k_elements", type=int, default=5)
     parser.add_argument("--retrieve_top_k", type=int, default=1)
+    parser.add_argument("--lazy_html", action="store_true",
+                        help="Keep samples as compact records and read html from the data files on access.")
+    parser.add_argument("--adaptive_obs", action="store_true",
+                        help="Shrink observations over the context limit instead of skipping the step.")
+    parser.add_argument("--obs_store_dir", type=str, default="data/obs_store",
+                        help="Directory of precomputed observations, used if present.")
+    parser.add_argument("--prune_cache_mb", type=int, default=256,
+                        help="Memory for cached pruned observations (0 to disable).")
+    parser.add_argument("--prune_cache_path", type=str, default=None,
+                        help="Sqlite file to also keep cached observations on disk.")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Processes building observations if not precomputed.")
 
     # workflow
     parser.add_argument("--website", type=str, required=True)
@@ -52,6 +160,8 @@ if __name__ == "__main__":
     parser.add_argument("--subdomain", type=str, default=None)
     parser.add_argument("--workflow_path", type=str, required=True)
     parser.add_argument("--suffix", type=str, default="workflow")
+    parser.add_argument("--workflow_code_path", type=str, default="data/workflow/code.py",
+                        help="Module defining `WORKFLOW_DICT`, used in `action` mode.")
 
     # ablation
     parser.add_argument("--mode", type=str, default="memory", choices=["memory", "action"])
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from collections import OrderedDict
+
+
+# %% prune cache
+class PruneCache:
+    """Pruned observations keyed by page content, candidates, and pruning parameters.
+
+    Keeps an in-memory LRU of at most `max_size` characters of observations,
+    and, if `disk_path` is given, writes every entry to a sqlite database that
+    serves as a second tier across runs and processes. Entries are not
+    versioned: remove the database after changing how observations are built.
+    """
+
+    def __init__(self, max_size: int, disk_path: str = None):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self.disk_path = disk_path
+        self.conn, self.pid = None, None
+
+    def get_conn(self) -> sqlite3.Connection | None:
+        """Connect to the disk tier, once per process (connections do not survive forks)."""
+        if self.disk_path is None:
+            return None
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.disk_path, timeout=30, isolation_level=None)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS obs (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self.pid = os.getpid()
+        return self.conn
+
+    def get(self, key: str) -> str | None:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        conn = self.get_conn()
+        if conn is not None:
+            row = conn.execute("SELECT value FROM obs WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                self.add(key, row[0])
+                return row[0]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, value: str):
+        self.add(key, value)
+        conn = self.get_conn()
+        if conn is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO obs (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    def add(self, key: str, value: str):
+        """Add an entry to the in-memory tier, evicting the least recently used."""
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        if len(value) > self.max_size:
+            return
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def close(self):
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+
+
+def get_html_hash(html: str) -> str:
+    return hashlib.blake2b(html.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def get_prune_key(html_hash: str, candidate_ids: list[str], **params) -> str:
+    """Key a pruned observation by the page hash, the candidate id set, and the
+    pruning and repr parameters."""
+    candidates = ",".join(sorted(set(candidate_ids)))
+    params = ",".join([f"{k}={v}" for k, v in sorted(params.items())])
+    return f"{html_hash}|{candidates}|{params}"
+
+
+# %% response cache
+class ResponseCache:
+    """Model responses keyed by request (see `get_response_key`), in a sqlite database.
+
+    Keeps at most `max_size` bytes of responses, evicting the least recently
+    used ones. Safe to share between processes.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.hits, self.misses = 0, 0
+        self.saved_prompt_tokens = 0
+        self.size = 0  # bytes of responses stored, read when connecting
+        self.conn, self.pid = None, None
+
+    def get_conn(self) -> sqlite3.Connection:
+        """Connect once per process (connections do not survive forks)."""
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, message TEXT, info TEXT, size INTEGER, used REAL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_used ON responses (used)"
+            )
+            self.size = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+            self.pid = os.getpid()
+        return self.conn
+
+    def get(self, key: str) -> tuple[str, dict[str, int]] | None:
+        conn = self.get_conn()
+        row = conn.execute(
+            "SELECT message, info FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        conn.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+        info = json.loads(row[1])
+        self.hits += 1
+        self.saved_prompt_tokens += info["prompt_tokens"]
+        return row[0], info
+
+    def put(self, key: str, message: str, info: dict[str, int]):
+        """Store a response, unless it alone is larger than `max_size`."""
+        info = json.dumps(info)
+        size = len(message.encode("utf-8")) + len(info)
+        if size > self.max_size:
+            return
+        conn = self.get_conn()
+        row = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, message, info, size, used) "
+            "VALUES (?, ?, ?, ?, ?)", (key, message, info, size, time.time()),
+        )
+        self.size += size - (row[0] if row is not None else 0)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used responses beyond `max_size`.
+
+        The size is tracked per process; other processes sharing the file are
+        accounted for when reconnecting, so the total can briefly exceed it.
+        """
+        conn = self.get_conn()
+        excess = self.size - self.max_size
+        keys = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY used"):
+            if excess <= 0:
+                break
+            keys.append(key)
+            excess -= size
+            self.size -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", [(k,) for k in keys])
+
+    def close(self):
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+
+
+def get_response_key(
+    model: str, messages: list[dict[str, str]], temperature: float,
+    stop_tokens: list[str] | None, **gen_kwargs,
+) -> str:
+    request = [model, messages, temperature, stop_tokens or None]
+    if gen_kwargs:
+        request.append(gen_kwargs)
+    request = json.dumps(request, sort_keys=True)
+    return hashlib.blake2b(request.encode("utf-8"), digest_size=16).hexdigest()
@@ -1,45 +1,490 @@
 import os
+import re
 import json
 import pickle
+import functools
+import numpy as np
 
 # %% load data
-def load_json(data_dir, folder_name):
+def get_data_paths(data_dir, folder_name) -> list[str]:
+    """Get the json shards of a split, in loading order."""
     folder_path = os.path.join(data_dir, folder_name)
-    print(f"Data path: {folder_path}")
     data_paths = [
         os.path.join(folder_path, file)
         for file in os.listdir(folder_path)
         if file.endswith(".json")
     ]
-    data_paths = sorted(data_paths, key=lambda x: int(x.split("_")[-1].split(".")[0]))
+    return sorted(data_paths, key=lambda x: int(x.split("_")[-1].split(".")[0]))
+
+
+def load_json(
+    data_dir, folder_name, website: str = None, index_dir: str = None,
+    use_cache: bool = True,
+):
+    """Load the samples of a split, or only those of `website` if given.
+
+    With a website index of the split (see `write_data_index`), only the byte
+    ranges of the website's samples are read and parsed. Otherwise shards are
+    loaded from their binary cache (see `load_shard`) unless `use_cache=False`.
+    """
+    folder_path = os.path.join(data_dir, folder_name)
+    print(f"Data path: {folder_path}")
+    if website is not None:
+        index = load_data_index(data_dir, folder_name, index_dir)
+        if index is not None:
+            samples = load_indexed_samples(folder_path, index, website=website)
+            print(f"# of samples on website [{website}]:", len(samples))
+            return samples
+    data_paths = get_data_paths(data_dir, folder_name)
 
     # Construct trajectory dataset
     samples = []
     for data_path in data_paths:
+        if use_cache:
+            samples.extend(load_shard(data_path))
+            continue
         with open(data_path, "r") as f:
             samples.extend(json.load(f))
     print("# of samples:", len(samples))
+    if website is not None:
+        samples = [s for s in samples if s["website"] == website]
+
+    return samples
+
+
+# %% binary cache
+def get_cache_path(data_path: str, cache_dir: str = None) -> str:
+    """Cache of `{data_dir}/{split}/{shard}.json` at `{cache_dir}/{split}/{shard}.json.pkl`,
+    by default with `cache_dir={data_dir}/cache`, outside the split folders so
+    that listing their shards is unaffected."""
+    folder_path, shard = os.path.split(data_path)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(folder_path), "cache")
+    return os.path.join(cache_dir, os.path.basename(folder_path), f"{shard}.pkl")
+
+
+def write_shard_cache(samples: list[dict], cache_path: str, stat: list[int]):
+    """Pickle the samples of a shard after the size and mtime of its json file."""
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as fw:
+            pickle.dump(stat, fw, protocol=5)
+            pickle.dump(samples, fw, protocol=5)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Failed to write data cache [{cache_path}]: {e}")
+
+
+def load_shard(data_path: str, cache_dir: str = None) -> list[dict]:
+    """Load the samples of a json shard, from its binary cache if the json file
+    is unchanged since, else by parsing it and (re)writing the cache."""
+    cache_path = get_cache_path(data_path, cache_dir)
+    stat = get_shard_stat(data_path)
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            if pickle.load(f) == stat:
+                return pickle.load(f)
+    with open(data_path, "r") as f:
+        samples = json.load(f)
+    write_shard_cache(samples, cache_path, stat)
+    return samples
+
+
+# %% website index
+def get_index_path(data_dir, folder_name, index_dir: str = None) -> str:
+    if index_dir is None:
+        index_dir = os.path.join(data_dir, "index")
+    return os.path.join(index_dir, f"{folder_name}.json")
+
+
+def get_shard_stat(path: str) -> list[int]:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
 
+
+HTML_FIELDS = ["raw_html", "cleaned_html"]
+HTML_KEY_PATTERN = re.compile(r'"(raw_html|cleaned_html)"\s*:\s*"')
+
+
+def to_byte_offsets(text: str, char_offsets: list[int], char_pos: int, byte_pos: int) -> list[int]:
+    """Convert ascending character offsets of `text` into utf-8 byte offsets,
+    starting from a known pair of character and byte positions."""
+    byte_offsets = []
+    for offset in char_offsets:
+        byte_pos += len(text[char_pos:offset].encode("utf-8"))
+        char_pos = offset
+        byte_offsets.append(byte_pos)
+    return byte_offsets
+
+
+def find_html_literals(text: str, start: int, end: int, sample: dict) -> list[int] | None:
+    """Find the character ranges of the json string literals of the html fields
+    of a sample's actions, as a flat list in file order. Returns None if they
+    cannot be matched to the parsed actions one to one."""
+    ranges, values = [], []
+    pos = start
+    while True:
+        match = HTML_KEY_PATTERN.search(text, pos, end)
+        if match is None:
+            break
+        i = match.start()
+        while text[i - 1] == "\\":
+            i -= 1
+        if (match.start() - i) % 2 == 1:  # an escaped quote inside a string value
+            pos = match.start() + 1
+            continue
+        value, pos = json.decoder.scanstring(text, match.end())
+        ranges.extend([match.end() - 1, pos])
+        values.append((match.group(1), value))
+    expected = [(k, a[k]) for a in sample["actions"] for k in a if k in HTML_FIELDS]
+    if values != expected:
+        return None
+    return ranges
+
+
+def write_data_index(data_dir, folder_name, index_dir: str = None) -> int:
+    """Record the shard, byte range, and website/domain/subdomain of every sample
+    of a split, in loading order, and the byte ranges of the html fields of its
+    actions (for `load_lazy_samples`)."""
+    decoder = json.JSONDecoder()
+    shards, samples = {}, []
+    for data_path in get_data_paths(data_dir, folder_name):
+        shard = os.path.basename(data_path)
+        shards[shard] = get_shard_stat(data_path)
+        with open(data_path, "rb") as f:
+            data = f.read()
+        text = data.decode("utf-8")
+        # walk the top-level array, tracking byte positions of each sample
+        pos, char_pos, byte_pos = text.index("[") + 1, 0, 0
+        while True:
+            while text[pos] in " \t\r\n,":
+                pos += 1
+            if text[pos] == "]":
+                break
+            sample, end = decoder.raw_decode(text, pos)
+            html_ranges = find_html_literals(text, pos, end, sample)
+            offsets = to_byte_offsets(
+                text, [pos] + (html_ranges or []) + [end], char_pos, byte_pos
+            )
+            char_pos, byte_pos = end, offsets[-1]
+            samples.append({
+                "shard": shard, "start": offsets[0], "end": offsets[-1],
+                "website": sample["website"],
+                "domain": sample["domain"], "subdomain": sample["subdomain"],
+                "html": offsets[1:-1] if html_ranges is not None else None,
+            })
+            pos = end
+
+    index_path = get_index_path(data_dir, folder_name, index_dir)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(index_path, "w") as fw:
+        json.dump({"shards": shards, "samples": samples}, fw)
+    return len(samples)
+
+
+def load_data_index(data_dir, folder_name, index_dir: str = None) -> dict | None:
+    """Load the website index of a split, if built and its shards are unchanged."""
+    index_path = get_index_path(data_dir, folder_name, index_dir)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, "r") as f:
+        index = json.load(f)
+    folder_path = os.path.join(data_dir, folder_name)
+    shard_paths = [os.path.basename(p) for p in get_data_paths(data_dir, folder_name)]
+    if sorted(shard_paths) != sorted(index["shards"]) or any([
+        get_shard_stat(os.path.join(folder_path, shard)) != stat
+        for shard, stat in index["shards"].items()
+    ]):
+        print(f"Index [{index_path}] is outdated, loading the full split")
+        return None
+    return index
+
+
+def load_indexed_samples(folder_path: str, index: dict, **tags) -> list[dict]:
+    """Parse only the samples whose tags (e.g., `website`) match, in loading order."""
+    samples, files = [], {}
+    for entry in index["samples"]:
+        if any([entry[k] != v for k, v in tags.items()]):
+            continue
+        if entry["shard"] not in files:
+            files[entry["shard"]] = open(os.path.join(folder_path, entry["shard"]), "rb")
+        f = files[entry["shard"]]
+        f.seek(entry["start"])
+        samples.append(json.loads(f.read(entry["end"] - entry["start"])))
+    for f in files.values():
+        f.close()
     return samples
 
 
+# %% lazy samples
+class Record:
+    """Dict-like record whose known keys (`FIELDS`) are slots; other keys go to `extra`."""
+
+    __slots__ = ("extra",)
+    FIELDS = ()
+
+    def __init__(self, data: dict):
+        self.extra = None
+        for key, value in data.items():
+            self[key] = value
+
+    def __getitem__(self, key: str):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> list[str]:
+        keys = [k for k in self.FIELDS if hasattr(self, k)]
+        return keys + list(self.extra or {})
+
+
+class Candidate(Record):
+    FIELDS = (
+        "backend_node_id", "tag", "attributes",
+        "is_original_target", "is_top_level_target", "score", "rank",
+    )
+    __slots__ = FIELDS
+
+
+class Action(Record):
+    """An action step, whose html fields are read from `html_source` on access.
+
+    `html_source` is `(shard path, {field: (start, end)})`, the byte ranges of
+    the json string literals of `raw_html` and `cleaned_html` in the shard.
+    """
+
+    FIELDS = (
+        "action_uid", "operation", "pos_candidates", "neg_candidates",
+        "neg_rank_order", "html_source",
+    )
+    __slots__ = FIELDS
+
+    def __getitem__(self, key: str):
+        if key in HTML_FIELDS and getattr(self, "html_source", None) is not None:
+            path, ranges = self.html_source
+            if key in ranges:
+                return read_html(path, *ranges[key])
+        return super().__getitem__(key)
+
+
+class Sample(Record):
+    FIELDS = (
+        "annotation_id", "confirmed_task", "website", "domain", "subdomain",
+        "action_reprs", "actions",
+    )
+    __slots__ = FIELDS
+
+
+@functools.lru_cache(maxsize=16)
+def read_html(path: str, start: int, end: int) -> str:
+    """Read an html field by the byte range of its json string literal."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        return json.loads(f.read(end - start))
+
+
+def to_sample_record(sample: dict, path: str = None, html_ranges: list[int] = None) -> Sample:
+    """Convert a parsed sample into records. With `html_ranges` (in file order,
+    as recorded by `write_data_index`), html fields are left in the shard."""
+    if html_ranges is not None:
+        html_ranges = iter(zip(html_ranges[0::2], html_ranges[1::2]))
+    actions = []
+    for a in sample["actions"]:
+        ranges = {}
+        if html_ranges is not None:
+            ranges = {k: next(html_ranges) for k in a if k in HTML_FIELDS}
+        action = Action({
+            k: [Candidate(c) for c in v] if k in ["pos_candidates", "neg_candidates"] else v
+            for k, v in a.items() if k not in ranges
+        })
+        action.html_source = (path, ranges) if ranges else None
+        actions.append(action)
+    return Sample({**sample, "actions": actions})
+
+
+def load_lazy_samples(
+    data_dir, folder_name, website: str = None, index_dir: str = None
+) -> list[Sample]:
+    """Load the samples of a split (or of `website`) as compact records, whose
+    html fields are read from the shards on first access.
+
+    Requires a website index of the split with html ranges (see
+    `write_data_index`); otherwise samples are fully parsed and converted.
+    """
+    folder_path = os.path.join(data_dir, folder_name)
+    index = load_data_index(data_dir, folder_name, index_dir)
+    if index is None:
+        return [to_sample_record(s) for s in load_json(data_dir, folder_name, website)]
+
+    print(f"Data path: {folder_path}")
+    samples, files = [], {}
+    for entry in index["samples"]:
+        if website is not None and entry["website"] != website:
+            continue
+        path = os.path.join(folder_path, entry["shard"])
+        if path not in files:
+            files[path] = open(path, "rb")
+        f = files[path]
+        html_ranges = entry.get("html")
+        # read the sample with its html literals replaced by empty strings
+        bounds = [entry["start"]] + (html_ranges or []) + [entry["end"]]
+        segments = []
+        for start, end in zip(bounds[0::2], bounds[1::2]):
+            f.seek(start)
+            segments.append(f.read(end - start))
+        sample = json.loads(b'""'.join(segments))
+        samples.append(to_sample_record(sample, path, html_ranges))
+    for f in files.values():
+        f.close()
+    if website is not None:
+        print(f"# of samples on website [{website}]:", len(samples))
+    else:
+        print("# of samples:", len(samples))
+    return samples
+
+
+# %% candidate scores
+SCORE_STORE_FIELDS = ["keys", "offsets", "candidate_ids", "scores", "ranks"]
+
+
+class ScoreStore:
+    """Columnar store of candidate scores and ranks, converted from `scores_all_data.pkl`.
+
+    Each field is a `.npy` array under `store_dir`: `keys` holds the sorted
+    sample ids (`{annotation_id}_{action_uid}`), and the candidates of the i-th
+    sample are `candidate_ids`, `scores` (float32), and `ranks` (int32) at
+    `offsets[i]: offsets[i+1]`. Arrays are memory-mapped on first access.
+    `source.json` records the pickle converted, see `load_candidate_results`.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.arrays = {}
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        if name not in SCORE_STORE_FIELDS:
+            raise AttributeError(name)
+        if name not in self.arrays:
+            path = os.path.join(self.store_dir, f"{name}.npy")
+            self.arrays[name] = np.load(path, mmap_mode="r")
+        return self.arrays[name]
+
+    def get(self, sample_id: str) -> dict[str, tuple[float, int]]:
+        """Get the {candidate_id: (score, rank)} of a sample."""
+        i = int(np.searchsorted(self.keys, sample_id))
+        if i == len(self.keys) or self.keys[i] != sample_id:
+            raise KeyError(sample_id)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return dict(zip(
+            self.candidate_ids[start:end].tolist(),
+            zip(self.scores[start:end].tolist(), self.ranks[start:end].tolist()),
+        ))
+
+
+def get_score_source_path(store_dir: str) -> str:
+    return os.path.join(store_dir, "source.json")
+
+
+def write_score_store(candidate_results: dict, store_dir: str, score_path: str = None) -> int:
+    """Convert the nested dicts of `scores_all_data.pkl` into a `ScoreStore`,
+    recording the size and mtime of the pickle at `score_path` if given."""
+    keys = sorted(candidate_results["scores"])
+    offsets, candidate_ids, scores, ranks = [0], [], [], []
+    for key in keys:
+        sample_scores = candidate_results["scores"][key]
+        sample_ranks = candidate_results["ranks"][key]
+        for candidate_id, score in sample_scores.items():
+            candidate_ids.append(candidate_id)
+            scores.append(score)
+            ranks.append(sample_ranks[candidate_id])
+        offsets.append(len(candidate_ids))
+
+    os.makedirs(store_dir, exist_ok=True)
+    source_path = get_score_source_path(store_dir)
+    if os.path.exists(source_path):
+        os.remove(source_path)
+    arrays = {
+        "keys": np.array(keys),
+        "offsets": np.array(offsets, dtype=np.int64),
+        "candidate_ids": np.array(candidate_ids),
+        "scores": np.array(scores, dtype=np.float32),
+        "ranks": np.array(ranks, dtype=np.int32),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(store_dir, f"{name}.npy"), array)
+    with open(source_path, "w") as fw:
+        json.dump({"score_path": score_path, "stat": score_path and get_shard_stat(score_path)}, fw)
+    return len(keys)
+
+
+def load_candidate_results(
+    score_path: str = "data/scores_all_data.pkl", store_dir: str = "data/scores"
+) -> ScoreStore | dict:
+    """Load candidate scores from the columnar store if converted from the
+    current pickle (or if the pickle is gone), else the pickle."""
+    source_path = get_score_source_path(store_dir)
+    if os.path.exists(source_path):
+        with open(source_path, "r") as f:
+            source = json.load(f)
+        if not os.path.exists(score_path) or source["stat"] == get_shard_stat(score_path):
+            return ScoreStore(store_dir)
+        print(f"Score store [{store_dir}] is outdated, loading [{score_path}]")
+    with open(score_path, "rb") as f:
+        return pickle.load(f)
+
+
 def add_scores(
-    examples: list[dict], candidate_results: dict = None,
-    score_path: str = "data/scores_all_data.pkl"
+    examples: list[dict], candidate_results: ScoreStore | dict = None,
+    score_path: str = "data/scores_all_data.pkl", store_dir: str = "data/scores",
 ):
     """Add prediction scores and ranks to candidate elements."""
     if candidate_results is None:
-        with open(score_path, "rb") as f:
-            candidate_results = pickle.load(f)
+        candidate_results = load_candidate_results(score_path, store_dir)
 
     for sample in examples:
         for s, act_repr in zip(sample["actions"], sample["action_reprs"]):
             sample_id = f"{sample['annotation_id']}_{s['action_uid']}"
+            if isinstance(candidate_results, ScoreStore):
+                sample_results = candidate_results.get(sample_id)
             for candidates in [s["pos_candidates"], s["neg_candidates"]]:
                 for candidate in candidates:
                     candidate_id = candidate["backend_node_id"]
+                    if isinstance(candidate_results, ScoreStore):
+                        candidate["score"], candidate["rank"] = sample_results[candidate_id]
+                        continue
                     candidate["score"] = candidate_results["scores"][sample_id][candidate_id]
                     candidate["rank"] = candidate_results["ranks"][sample_id][candidate_id]
+            # negative ids in rank order, so top-k selection is a slice
+            neg_ids = np.array([c["backend_node_id"] for c in s["neg_candidates"]])
+            neg_ranks = np.array([c["rank"] for c in s["neg_candidates"]])
+            s["neg_rank_order"] = neg_ids[np.argsort(neg_ranks, kind="stable")]
     
     return examples
 
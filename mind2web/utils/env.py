@@ -4,12 +4,153 @@ import json
 import os
 import string
 import ast
+import functools
+import importlib.util
+import multiprocessing
 from lxml import etree
+from utils.cache import PruneCache, get_html_hash, get_prune_key
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class NodeIndex:
+    """Element lookups of a parsed html tree, built in one pass over the tree.
+
+    `nodes` maps each `backend_node_id` to the first element carrying it in
+    document order, i.e., the element the `//*[@backend_node_id=...]` xpath
+    returns. Action uids, aria labels, and sibling positions are indexed on
+    first use.
+    """
+
+    def __init__(self, dom_tree):
+        self.dom_tree = dom_tree
+        self.nodes = {}
+        for node in dom_tree.iter(tag=etree.Element):
+            node_id = node.get("backend_node_id")
+            if node_id is not None and node_id not in self.nodes:
+                self.nodes[node_id] = node
+        self.action_uids = None
+        self.aria_labels = None
+        self.siblings = {}
+
+    def get_node(self, node_id: str):
+        return self.nodes[node_id]
+
+    def get_action_node(self, action_uid: str):
+        """Get the element annotated with `data_pw_testid_buckeye=action_uid`."""
+        if self.action_uids is None:
+            self.action_uids = {}
+            for node in self.dom_tree.iter(tag=etree.Element):
+                uid = node.get("data_pw_testid_buckeye")
+                if uid is not None and uid not in self.action_uids:
+                    self.action_uids[uid] = node
+        return self.action_uids[action_uid]
+
+    def get_aria_node(self, aria_label: str):
+        """Get the first element with `aria_label=aria_label`."""
+        if self.aria_labels is None:
+            self.aria_labels = {}
+            for node in self.dom_tree.iter(tag=etree.Element):
+                label = node.get("aria_label")
+                if label is not None and label not in self.aria_labels:
+                    self.aria_labels[label] = node
+        return self.aria_labels[aria_label]
+
+    def get_siblings(self, node) -> tuple[list, int]:
+        """Get the non-text siblings of a node and its position among them."""
+        parent = node.getparent()
+        if parent not in self.siblings:
+            siblings = [x for x in parent.getchildren() if x.tag != "text"]
+            positions = {x: i for i, x in enumerate(siblings)}
+            self.siblings[parent] = (siblings, positions)
+        siblings, positions = self.siblings[parent]
+        return siblings, positions[node]
+
+
+class StepTrees:
+    """Parsed html trees of a single action step.
+
+    Each html field (`cleaned_html`, `raw_html`) is parsed on first access and
+    then shared by all observation builders of the step, together with its
+    `NodeIndex`.
+    """
+
+    def __init__(self, step: dict):
+        self.step = step
+        self.trees = {}
+        self.indices = {}
+        self.raw_target = None  # (id, repr) of the ground-truth element in `raw_html`
+        self.hashes = {}
+
+    def get(self, key: str = "cleaned_html"):
+        if key not in self.trees:
+            self.trees[key] = etree.fromstring(self.step[key])
+        return self.trees[key]
+
+    def get_index(self, key: str = "cleaned_html") -> NodeIndex:
+        if key not in self.indices:
+            self.indices[key] = NodeIndex(self.get(key))
+        return self.indices[key]
+
+    def get_hash(self, key: str = "cleaned_html") -> str:
+        if key not in self.hashes:
+            self.hashes[key] = get_html_hash(self.step[key])
+        return self.hashes[key]
+
+
+# shared by all steps, see `set_prune_cache`
+prune_cache: PruneCache | None = None
+
+
+def set_prune_cache(cache: PruneCache | None):
+    """Cache pruned observations across steps, and tasks sharing the same pages."""
+    global prune_cache
+    prune_cache = cache
+
+
+def get_cached_target_obs(
+    trees: StepTrees, target_element_ids, key: str = "cleaned_html",
+    max_depth: int = 5, max_children: int = 50, max_sibling: int = 3,
+    max_value_length: int = 5, max_length: int = 20,
+) -> str:
+    """`get_target_obs` on the `key` html of a step, looked up in the prune cache
+    first, so a cached page is not parsed again."""
+    params = dict(
+        max_depth=max_depth, max_children=max_children, max_sibling=max_sibling,
+        max_value_length=max_value_length, max_length=max_length,
+    )
+    if prune_cache is None:
+        return get_target_obs(
+            trees.get(key), target_element_ids, trees.get_index(key), **params
+        )
+    cache_key = get_prune_key(trees.get_hash(key), target_element_ids, **params)
+    obs = prune_cache.get(cache_key)
+    if obs is None:
+        obs = get_target_obs(
+            trees.get(key), target_element_ids, trees.get_index(key), **params
+        )
+        prune_cache.put(cache_key, obs)
+    return obs
 
 
-def get_target_obs(dom_tree, target_element_ids):
-    pruned_tree = prune_tree(dom_tree, target_element_ids)
-    tree_repr, _ = get_tree_repr(pruned_tree, id_mapping={}, keep_html_brackets=True)
+def get_target_obs(
+    dom_tree, target_element_ids, index: NodeIndex = None, single_pass: bool = True,
+    max_depth: int = 5, max_children: int = 50, max_sibling: int = 3,
+    max_value_length: int = 5, max_length: int = 20,
+):
+    if single_pass:
+        return get_pruned_tree_repr(
+            dom_tree, target_element_ids, max_depth, max_children, max_sibling,
+            keep_html_brackets=True, index=index,
+            max_value_length=max_value_length, max_length=max_length,
+        )
+    pruned_tree = prune_tree(
+        dom_tree, target_element_ids, max_depth, max_children, max_sibling, index=index
+    )
+    tree_repr, _ = get_tree_repr(
+        pruned_tree, max_value_length, max_length, id_mapping={}, keep_html_brackets=True
+    )
 
     return tree_repr
 
@@ -40,60 +181,79 @@ def parse_act_str(act_str):
 
 
 
-def find_node_id_by_text(example, text):
-    dom_tree = etree.fromstring(example["cleaned_html"])
-    node = dom_tree.xpath(f'//*[@aria_label="{text}"]')[0]
+def find_node_id_by_text(example, text, trees: StepTrees = None):
+    if trees is None:
+        trees = StepTrees(example)
+    node = trees.get_index("cleaned_html").get_aria_node(text)
     return node.attrib["backend_node_id"]
 
 
-def parse_act_str_workflow(act_str, example):
-    # Compile the regular expression pattern
+WORKFLOW_CODE_PATH = os.path.join("data", "workflow", "code.py")
+
+
+@functools.lru_cache(maxsize=None)
+def get_workflow_registry(code_path: str = WORKFLOW_CODE_PATH) -> dict:
+    """Load the `WORKFLOW_DICT` of workflow functions once per code file."""
+    spec = importlib.util.spec_from_file_location("workflow_code", code_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.WORKFLOW_DICT
+
+
+def expand_act_str(
+    act_str: str, examples: list[dict], code_path: str = WORKFLOW_CODE_PATH
+) -> list[str]:
+    """Expand an action string into element-level actions.
+
+    A plain action is returned as is. A workflow call, e.g., `search(from="NYC")`,
+    is expanded with the workflow registry, and its j-th step is grounded by
+    aria label on the page of `examples[j]` (the last one for later steps).
+    Steps that cannot be expanded or grounded become empty actions.
+    """
     pattern = re.compile(r"(?:^|\s)(CLICK|SELECT|TYPE)?\s?\[(.+?)\](?:\s\[(.+?)\])?")
-    # Search for the pattern in the string
-    match = pattern.search(act_str)
-    if match:
-        # Extract the matching groups
-        action_op = match.group(1)  # This will be None if not in the list
-        target_element_id = match.group(2)
-        action_value = match.group(3)  # This will be None if not present
-        yield action_op, target_element_id, action_value
-    elif ('(' in act_str) and (')' in act_str):
-        print("Action Str: ", act_str)
-        from data.workflow.code import WORKFLOW_DICT
-        s, e = act_str.index('('), act_str.index(')')
-        wkfl = act_str[: s].strip()
-        print("Workflow: ", wkfl)
-        if wkfl not in WORKFLOW_DICT: yield None, None, None
-        args = [arg.value for arg in ast.parse(act_str).body[0].value.args]
-        if args == []:
-            args = act_str[s: e].split(',')
-            for i in range(len(args)):
-                if '=' in args[i]: args[i] = args[i].split('=')[1]
-        print("Args: ", args)
-        # args = [arg.strip() for arg in act_str[s+1: e].split(',')]
-        steps = WORKFLOW_DICT[wkfl](*args)
-        for step in steps:
-            print("Org Step: ", step)
-            element_name, op_name = step.split('->')
-            s = element_name.index(']') + 1
-            element_name = element_name[s:].strip()
-            if ':' in op_name:
-                op_name, arg = [item.strip() for item in op_name.split(':')]
+    if pattern.search(act_str) or not (("(" in act_str) and (")" in act_str)):
+        return [act_str]
+
+    workflow_dict = get_workflow_registry(code_path)
+    wkfl = act_str[: act_str.index("(")].strip()
+    logger.debug(f"Workflow: {wkfl}")
+    if wkfl not in workflow_dict:
+        return [""]
+    try:
+        call = ast.parse(act_str.strip()).body[0].value
+        args = [arg.value for arg in call.args]
+        kwargs = {kw.arg: kw.value.value for kw in call.keywords}
+        steps = workflow_dict[wkfl](*args, **kwargs)
+    except Exception:
+        return [""]
+    logger.debug(f"Args: {args}, {kwargs}")
+
+    acts, trees = [], {}
+    for j, step in enumerate(steps):
+        example = examples[min(j, len(examples) - 1)]
+        try:
+            element_name, op_name = step.split("->")
+            element_name = element_name[element_name.index("]") + 1 :].strip()
+            if ":" in op_name:
+                op_name, arg = [item.strip() for item in op_name.split(":")]
             else:
-                arg = None
-            try:
-                element_id = find_node_id_by_text(example, element_name)
-                step = f"{op_name} [{element_id}]"
-                if arg is not None:
-                    step += f" [{arg}]"
-                step = step.replace('"', '')
-                print("New Step: ", step)
-                yield parse_act_str(step)
-            except: 
-                yield None, None, None
+                op_name, arg = op_name.strip(), None
+            if id(example) not in trees:
+                trees[id(example)] = StepTrees(example)
+            element_id = find_node_id_by_text(example, element_name, trees[id(example)])
+            act = f"{op_name} [{element_id}]"
+            if arg is not None:
+                act += f" [{arg}]"
+            acts.append(act.replace('"', ""))
+        except Exception:
+            acts.append("")
+        logger.debug(f"Step: {step} -> {acts[-1]}")
+    return acts or [""]
 
-    else:
-        yield None, None, None
+
+def parse_act_str_workflow(act_str, example, code_path: str = WORKFLOW_CODE_PATH):
+    for act in expand_act_str(act_str, [example], code_path):
+        yield parse_act_str(act)
 
 
 def construct_act_str(op, val):
@@ -106,113 +266,244 @@ def construct_act_str(op, val):
     return f"{op} {val}"
 
 
-def get_target_obs_and_act(example):
+# raw_html pages larger than this (in characters) are streamed, see `stream_target_tree`
+RAW_HTML_STREAM_SIZE = 1 << 20
+
+
+def stream_target_tree(
+    html: str, action_uid: str, max_sibling: int = 3, chunk_size: int = 1 << 16
+):
+    """Parse only the part of a page that the raw target observation reads.
+
+    Feeds `html` to an incremental parser in chunks and keeps the ancestors of
+    the element annotated with `action_uid`, its subtree, and up to
+    `max_sibling` non-text siblings on each side, stripped to their ids. Other
+    elements are discarded once parsed, and parsing stops after the last
+    sibling is seen. Returns (partial tree, target element), or None if the
+    target is missing or an earlier element has the same `backend_node_id`.
+    """
+    parser = etree.XMLPullParser(events=("start", "end"))
+    root, target, target_parent, target_done = None, None, None, False
+    seen_ids, num_following = set(), 0
+    for i in range(0, len(html), chunk_size):
+        parser.feed(html[i : i + chunk_size])
+        for event, node in parser.read_events():
+            if root is None:
+                root = node
+            if event == "start":
+                if target is None:
+                    if node.get("data_pw_testid_buckeye") == action_uid:
+                        if node.get("backend_node_id") in seen_ids:
+                            return None
+                        target, target_parent = node, node.getparent()
+                    else:
+                        seen_ids.add(node.get("backend_node_id"))
+                elif target_done and node.getparent() is target_parent:
+                    if node.tag != "text":
+                        num_following += 1
+                        if num_following >= max_sibling:
+                            return root, target
+                continue
+
+            if node is target:
+                target_done = True
+                if max_sibling == 0:
+                    return root, target
+            elif node is target_parent:
+                return root, target
+            elif target is not None and not target_done:
+                continue  # inside the target subtree
+            else:
+                parent = node.getparent()
+                if parent is None:
+                    break
+                # keep the ended element as a possible sibling, with its id only;
+                # the parser may still append to its parent, so only elements
+                # before it are removed
+                node_id = node.get("backend_node_id")
+                node.clear()
+                if node_id is not None and node.tag != "text":
+                    node.set("backend_node_id", node_id)
+                if target_done and parent is target_parent:
+                    continue
+                num_kept, prev = int(node.tag != "text"), node.getprevious()
+                while prev is not None:
+                    before = prev.getprevious()
+                    if (
+                        target is None and num_kept < max_sibling
+                        and isinstance(prev.tag, str) and prev.tag != "text"
+                    ):
+                        num_kept += 1
+                    else:
+                        parent.remove(prev)
+                    prev = before
+    if target is None or not target_done:
+        return None
+    return root, target
+
+
+def get_raw_target_obs(example: dict, trees: StepTrees = None) -> tuple[str, str]:
+    """Get the ground-truth element of a step from its `raw_html`.
+
+    Locates the element by its `data_pw_testid_buckeye` action uid and returns
+    its id and the repr of its subtree in the pruned raw tree. Pages over
+    `RAW_HTML_STREAM_SIZE` are streamed instead of parsed into a full tree.
+    """
+    if trees is None:
+        trees = StepTrees(example)
+    if trees.raw_target is not None:
+        return trees.raw_target
+    partial = None
+    if "raw_html" not in trees.trees and len(example["raw_html"]) > RAW_HTML_STREAM_SIZE:
+        partial = stream_target_tree(example["raw_html"], example["action_uid"])
+    if partial is not None:
+        dom_tree, gt_element = partial
+        index = NodeIndex(dom_tree)
+    else:
+        dom_tree, index = trees.get("raw_html"), trees.get_index("raw_html")
+        gt_element = index.get_action_node(example["action_uid"])
+    element_id = gt_element.get("backend_node_id")
+    target_element = get_pruned_tree_repr(
+        dom_tree, [element_id], keep_html_brackets=True, index=index, root=gt_element
+    )
+    trees.raw_target = (element_id, target_element)
+    return trees.raw_target
+
+
+def get_target_obs_and_act(example, trees: StepTrees = None):
+    if trees is None:
+        trees = StepTrees(example)
     if len(example["pos_candidates"]) == 0:
         # Simplify the raw_html if pos_candidates is empty (not in the cleaned html)
-        dom_tree = etree.fromstring(example["raw_html"])
-        gt_element = dom_tree.xpath(
-            f"//*[@data_pw_testid_buckeye='{example['action_uid']}']"
-        )
-        element_id = gt_element[0].get("backend_node_id")
-        raw_obs = get_target_obs(dom_tree, [element_id])
-        # Find the start index of the target element using the element ID
-        start_idx = raw_obs.find(f"id={element_id}")
-        # Find the start tag for the target element
-        start_tag_idx = raw_obs.rfind("<", 0, start_idx)
-        end_tag_idx = raw_obs.find(">", start_idx)
-        # Extract the tag name
-        tag_name = raw_obs[start_tag_idx + 1 : end_tag_idx].split()[0]
-        # Initialize count for open and close tags
-        open_count = 0
-        close_count = 0
-        search_idx = start_tag_idx
-        while True:
-            # Find the next open or close tag of the same type
-            next_open_tag = raw_obs.find(f"<{tag_name}", search_idx)
-            next_close_tag = raw_obs.find(f"</{tag_name}>", search_idx)
-            # No more tags found, break
-            if next_open_tag == -1 and next_close_tag == -1:
-                break
-            # Decide whether the next tag is an open or close tag
-            if next_open_tag != -1 and (
-                next_open_tag < next_close_tag or next_close_tag == -1
-            ):
-                open_count += 1
-                search_idx = raw_obs.find(">", next_open_tag) + 1
-            else:
-                close_count += 1
-                search_idx = next_close_tag + len(f"</{tag_name}>")
-            # If we've closed all open tags, break
-            if open_count == close_count:
-                break
-        # Extract the target element
-        o = f"<html> {raw_obs[start_tag_idx:search_idx]} </html>"
+        element_id, target_element = get_raw_target_obs(example, trees)
+        o = f"<html> {target_element} </html>"
         a = get_target_act(example, element_id)
     else:
-        dom_tree = etree.fromstring(example["cleaned_html"])
         element_id = example["pos_candidates"][0]["backend_node_id"]
-        o = get_target_obs(dom_tree, [element_id])
+        o = get_cached_target_obs(trees, [element_id])
         a = get_target_act(example, element_id)
 
     return o, a
 
 
-def get_top_k_obs(s: dict, top_k: int, use_raw: bool = True) -> tuple[str, str]:
+def get_top_k_obs(
+    s: dict, top_k: int, use_raw: bool = True, trees: StepTrees = None,
+    max_value_length: int = 5, max_length: int = 20,
+) -> tuple[str, str]:
+    if trees is None:
+        trees = StepTrees(s)
     # Find one positive candidate (it can be zero)
     pos_candidates = s["pos_candidates"]
     pos_ids = [c["backend_node_id"] for c in pos_candidates][:1]
     # Find top_k - 1 negative candidates
-    neg_candidates = s["neg_candidates"]
-    neg_candidates = sorted(neg_candidates, key=lambda c: c["rank"])[: top_k - 1]
-    neg_ids = [c["backend_node_id"] for c in neg_candidates]
+    if "neg_rank_order" in s:
+        neg_ids = s["neg_rank_order"][: top_k - 1].tolist()
+    else:
+        neg_candidates = sorted(s["neg_candidates"], key=lambda c: c["rank"])[: top_k - 1]
+        neg_ids = [c["backend_node_id"] for c in neg_candidates]
     # Prune html with all candidates
     all_candidates = pos_ids + neg_ids
-    obs = get_target_obs(etree.fromstring(s["cleaned_html"]), all_candidates)
+    obs = get_cached_target_obs(
+        trees, all_candidates,
+        max_value_length=max_value_length, max_length=max_length,
+    )
     # If there is no positive candidate in cleaned_html, get it from raw_html
     if len(s["pos_candidates"]) == 0:
         assert use_raw
         # Simplify the raw_html if pos_candidates is empty (not in the cleaned html)
-        dom_tree = etree.fromstring(s["raw_html"])
-        gt_element = dom_tree.xpath(f"//*[@data_pw_testid_buckeye='{s['action_uid']}']")
-        element_id = gt_element[0].get("backend_node_id")
-        raw_obs = get_target_obs(dom_tree, [element_id])
-        # Find the start index of the target element using the element ID
-        start_idx = raw_obs.find(f"id={element_id}")
-        # Find the start tag for the target element
-        start_tag_idx = raw_obs.rfind("<", 0, start_idx)
-        end_tag_idx = raw_obs.find(">", start_idx)
-        # Extract the tag name
-        tag_name = raw_obs[start_tag_idx + 1 : end_tag_idx].split()[0]
-        # Initialize count for open and close tags
-        open_count = 0
-        close_count = 0
-        search_idx = start_tag_idx
-        while True:
-            # Find the next open or close tag of the same type
-            next_open_tag = raw_obs.find(f"<{tag_name}", search_idx)
-            next_close_tag = raw_obs.find(f"</{tag_name}>", search_idx)
-            # No more tags found, break
-            if next_open_tag == -1 and next_close_tag == -1:
-                break
-            # Decide whether the next tag is an open or close tag
-            if next_open_tag != -1 and (
-                next_open_tag < next_close_tag or next_close_tag == -1
-            ):
-                open_count += 1
-                search_idx = raw_obs.find(">", next_open_tag) + 1
-            else:
-                close_count += 1
-                search_idx = next_close_tag + len(f"</{tag_name}>")
-            # If we've closed all open tags, break
-            if open_count == close_count:
-                break
-        # Extract the target element
-        target_element = raw_obs[start_tag_idx:search_idx]
+        _, target_element = get_raw_target_obs(s, trees)
         obs = obs.replace("</html>", f"{target_element} </html>")
 
     return obs, all_candidates
 
 
+def build_step_obs(s: dict, top_k: int, previous_top_k: int) -> dict:
+    """Build the target action, history observation, and current observation of a step.
+
+    The current observation `obs` is only built (otherwise None) when a positive
+    candidate ranks within `top_k`, since steps without one are not queried.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        meta_info = compute_attribute_meta.cache_info()
+    trees = StepTrees(s)  # parse the step html once for all observations
+    _, target_act = get_target_obs_and_act(s, trees)
+    target_obs, _ = get_top_k_obs(s, previous_top_k, trees=trees)
+    obs = None
+    if any([c["rank"] < top_k for c in s["pos_candidates"]]):
+        obs, _ = get_top_k_obs(s, top_k, use_raw=False, trees=trees)
+    if logger.isEnabledFor(logging.DEBUG):
+        log_meta_cache_stats(meta_info)
+    return {"target_act": target_act, "target_obs": target_obs, "obs": obs}
+
+
+def log_meta_cache_stats(prev_info=None):
+    """Log the hit rate of the attribute meta cache, overall and since `prev_info`."""
+    info = compute_attribute_meta.cache_info()
+    message = (
+        f"attribute meta cache: {info.hits} hits / {info.misses} misses "
+        f"({info.hits / max(info.hits + info.misses, 1):.1%}), size {info.currsize}"
+    )
+    if prev_info is not None:
+        message += (
+            f", step: {info.hits - prev_info.hits} hits / "
+            f"{info.misses - prev_info.misses} misses"
+        )
+    logger.debug(message)
+
+
+def get_step_payload(s: dict) -> dict:
+    """Get the step fields read by `build_step_obs`, to ship to pool workers."""
+    payload = {
+        "cleaned_html": s["cleaned_html"],
+        "action_uid": s["action_uid"],
+        "operation": s["operation"],
+        "pos_candidates": [
+            {"backend_node_id": c["backend_node_id"], "rank": c["rank"]}
+            for c in s["pos_candidates"]
+        ],
+    }
+    if len(s["pos_candidates"]) == 0:
+        payload["raw_html"] = s["raw_html"]
+    if "neg_rank_order" in s:
+        payload["neg_rank_order"] = s["neg_rank_order"]
+    else:
+        payload["neg_candidates"] = [
+            {"backend_node_id": c["backend_node_id"], "rank": c["rank"]}
+            for c in s["neg_candidates"]
+        ]
+    return payload
+
+
+def iter_step_obs(
+    steps, top_k: int, previous_top_k: int, num_workers: int = 1, chunksize: int = 4
+):
+    """Build the `build_step_obs` records of steps, in order.
+
+    With `num_workers > 1`, observations are built in a process pool that is
+    sent only the html strings and candidate ids of each step, `chunksize`
+    steps at a time.
+    """
+    build = functools.partial(build_step_obs, top_k=top_k, previous_top_k=previous_top_k)
+    if num_workers <= 1:
+        yield from map(build, steps)
+        return
+    with multiprocessing.Pool(num_workers) as pool:
+        yield from pool.imap(build, map(get_step_payload, steps), chunksize=chunksize)
+
+
+def get_step_metrics(pred_act: str, target_act: str, pos_ids: list[str]) -> tuple[int, float, int]:
+    """Get the element accuracy, action f1, and step success of a predicted action."""
+    pred_op, pred_id, pred_val = parse_act_str(pred_act)
+    target_op, _, target_val = parse_act_str(target_act)
+    element_acc = int(pred_id in pos_ids)
+    action_f1 = calculate_f1(
+        construct_act_str(pred_op, pred_val),
+        construct_act_str(target_op, target_val),
+    )
+    step_success = int(pred_act == target_act)
+    return element_acc, action_f1, step_success
+
+
 def calculate_f1(pred, label):
     pred = set(pred.strip().split())
     label = set(label.strip().split())
@@ -247,71 +538,89 @@ def get_descendants(node, max_depth, current_depth=0):
     return descendants
 
 
-def get_attribute_repr(node, max_value_length=5, max_length=20):
-    # get attribute values in order
+META_ATTRIBUTES = (
+    "role",
+    "aria_role",
+    "type",
+    "alt",
+    "aria_description",
+    "aria_label",
+    "label",
+    "title",
+    "name",
+    "text_value",
+    "value",
+    "placeholder",
+    "input_checked",
+    "input_value",
+    "option_selected",
+    "class",
+)
+# less meaningful values
+META_STOP_VALUES = frozenset(["hidden", "none", "presentation", "null", "undefined"])
+
+
+def get_attribute_meta(attrib, max_value_length=5, max_length=20) -> str:
+    """Summarize the meaningful attribute values of a node into a `meta` string."""
+    values = tuple([attrib.get(attr) for attr in META_ATTRIBUTES])
+    return compute_attribute_meta(values, max_value_length, max_length)
+
+
+@functools.lru_cache(maxsize=65536)
+def compute_attribute_meta(values: tuple, max_value_length=5, max_length=20) -> str:
+    """Build the `meta` string from the `META_ATTRIBUTES` values of a node.
+
+    Pages repeat the same attribute values across many elements (menu items,
+    table cells), so results are cached on the value tuple.
+    """
     attr_values_set = set()
     attr_values = ""
-    for attr in [
-        "role",
-        "aria_role",
-        "type",
-        "alt",
-        "aria_description",
-        "aria_label",
-        "label",
-        "title",
-        "name",
-        "text_value",
-        "value",
-        "placeholder",
-        "input_checked",
-        "input_value",
-        "option_selected",
-        "class",
-    ]:
-        if attr in node.attrib and node.attrib[attr] is not None:
-            value = node.attrib[attr].lower()
-            # less menaingful values
-            if value in [
-                "hidden",
-                "none",
-                "presentation",
-                "null",
-                "undefined",
-            ] or value.startswith("http"):
-                continue
-            value = value.split()
-            value = " ".join([v for v in value if len(v) < 15][:max_value_length])
-            if value and value not in attr_values_set:
-                attr_values_set.add(value)
-                attr_values += value + " "
+    for value in values:
+        if value is None:
+            continue
+        value = value.lower()
+        if value in META_STOP_VALUES or value.startswith("http"):
+            continue
+        value = value.split()
+        value = " ".join([v for v in value if len(v) < 15][:max_value_length])
+        if value and value not in attr_values_set:
+            attr_values_set.add(value)
+            attr_values += value + " "
+    return " ".join(attr_values.split()[:max_length])
+
+
+def get_attribute_repr(node, max_value_length=5, max_length=20):
+    meta = get_attribute_meta(node.attrib, max_value_length, max_length)
     uid = node.attrib.get("backend_node_id", "")
     # clear all attributes
     node.attrib.clear()
     if uid:
         node.attrib["id"] = uid
     # add meta attribute
-    if attr_values:
-        node.attrib["meta"] = " ".join(attr_values.split()[:max_length])
-
+    if meta:
+        node.attrib["meta"] = meta
 
 
-def prune_tree(
+def get_nodes_to_keep(
     dom_tree,
     candidate_set,
     max_depth=5,
     max_children=50,
     max_sibling=3,
-):
+    index: NodeIndex = None,
+) -> set[str]:
+    """Collect ids of the candidates, their ancestors, descendants, and siblings."""
+    if index is None:
+        index = NodeIndex(dom_tree)
     nodes_to_keep = set()
     for candidate_id in candidate_set:
-        candidate_node = dom_tree.xpath(f'//*[@backend_node_id="{candidate_id}"]')[0]
+        candidate_node = index.get_node(candidate_id)
         nodes_to_keep.add(candidate_node.attrib["backend_node_id"])
         # get all ancestors
         nodes_to_keep.update(
             [
                 x.attrib.get("backend_node_id", "")
-                for x in candidate_node.xpath("ancestor::*")
+                for x in candidate_node.iterancestors()
             ]
         )
         # get descendants with max depth
@@ -324,8 +633,7 @@ def prune_tree(
         # get siblings within range
         parent = candidate_node.getparent()
         if parent is not None:
-            siblings = [x for x in parent.getchildren() if x.tag != "text"]
-            idx_in_sibling = siblings.index(candidate_node)
+            siblings, idx_in_sibling = index.get_siblings(candidate_node)
             nodes_to_keep.update(
                 [
                     x.attrib.get("backend_node_id", "")
@@ -336,39 +644,311 @@ def prune_tree(
                     ]
                 ]
             )
+    return nodes_to_keep
+
+
+def prune_tree(
+    dom_tree,
+    candidate_set,
+    max_depth=5,
+    max_children=50,
+    max_sibling=3,
+    index: NodeIndex = None,
+):
+    nodes_to_keep = get_nodes_to_keep(
+        dom_tree, candidate_set, max_depth, max_children, max_sibling, index
+    )
     # clone the tree
     new_tree = copy.deepcopy(dom_tree)
     # remove nodes not in nodes_to_keep
-    for node in new_tree.xpath("//*")[::-1]:
+    for node in list(new_tree.iter(tag=etree.Element))[::-1]:
+        parent = node.getparent()
         if node.tag != "text":
-            is_keep = node.attrib.get("backend_node_id", "") in nodes_to_keep
-            is_candidate = node.attrib.get("backend_node_id", "") in candidate_set
+            node_id = node.get("backend_node_id", "")
         else:
-            is_keep = (
-                node.getparent().attrib.get("backend_node_id", "") in nodes_to_keep
-            )
-            is_candidate = (
-                node.getparent().attrib.get("backend_node_id", "") in candidate_set
-            )
-        if not is_keep and node.getparent() is not None:
-            node.getparent().remove(node)
+            node_id = parent.get("backend_node_id", "")
+        is_keep = node_id in nodes_to_keep
+        is_candidate = node_id in candidate_set
+        if not is_keep and parent is not None:
+            parent.remove(node)
         else:
             if not is_candidate or node.tag == "text":
                 node.attrib.pop("backend_node_id", None)
             if (
                 len(node.attrib) == 0
                 and not any([x.tag == "text" for x in node.getchildren()])
-                and node.getparent() is not None
+                and parent is not None
                 and node.tag != "text"
                 and len(node.getchildren()) <= 1
             ):
                 # insert all children into parent
                 for child in node.getchildren():
                     node.addprevious(child)
-                node.getparent().remove(node)
+                parent.remove(node)
     return new_tree
 
 
+def get_prune_actions(dom_tree, candidate_set, nodes_to_keep) -> dict:
+    """Decide what `prune_tree` does to each element, without modifying the tree.
+
+    Returns {element: (action, #children)}, where action is "keep", "drop", or
+    "unwrap" (replaced by its children), and #children counts the children the
+    element has after pruning. Children are decided before their parents, as
+    in `prune_tree`, and subtrees of dropped elements are never visited.
+    """
+    actions = {}
+    stack = [(dom_tree, False)]
+    while stack:
+        node, visited = stack.pop()
+        parent = node.getparent()
+        if node.tag != "text":
+            node_id = node.get("backend_node_id", "")
+        else:
+            node_id = parent.get("backend_node_id", "")
+        if not visited:
+            if node_id not in nodes_to_keep and parent is not None:
+                actions[node] = ("drop", 0)
+            else:
+                stack.append((node, True))
+                stack.extend([(c, False) for c in node.iterchildren(tag=etree.Element)])
+            continue
+
+        # count children after pruning, and whether any of them is a text node
+        num_children, has_text = 0, False
+        for child in node:
+            if not isinstance(child.tag, str):  # comments are always kept
+                num_children += 1
+                continue
+            action, n = actions[child]
+            if action == "keep":
+                num_children += 1
+                has_text = has_text or (child.tag == "text")
+            elif action == "unwrap":
+                num_children += n
+        num_attrib = len(node.attrib)
+        if ("backend_node_id" in node.attrib) and (
+            (node_id not in candidate_set) or (node.tag == "text")
+        ):
+            num_attrib -= 1
+        if (
+            num_attrib == 0
+            and not has_text
+            and parent is not None
+            and node.tag != "text"
+            and num_children <= 1
+        ):
+            actions[node] = ("unwrap", num_children)
+        else:
+            actions[node] = ("keep", num_children)
+    return actions
+
+
+def escape_text(text: str) -> str:
+    return (
+        text.replace("&", "&amp;").replace("<", "&lt;")
+        .replace(">", "&gt;").replace("\r", "&#13;")
+    )
+
+
+def escape_attribute(value: str) -> str:
+    return (
+        value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        .replace('"', "&quot;").replace("\n", "&#10;").replace("\r", "&#13;")
+        .replace("\t", "&#9;")
+    )
+
+
+def get_node_repr(node, candidate_set, max_value_length=5, max_length=20):
+    """Get the attributes and text of a kept node as `get_tree_repr` rewrites them."""
+    if node.tag == "text":
+        attrib = [(k, v) for k, v in node.attrib.items() if k != "backend_node_id"]
+        return attrib, " ".join(node.text.split()[:max_length])
+    attrib = []
+    uid = node.get("backend_node_id", "")
+    if uid and uid in candidate_set:
+        attrib.append(("id", uid))
+    meta = get_attribute_meta(node.attrib, max_value_length, max_length)
+    if meta:
+        attrib.append(("meta", meta))
+    return attrib, node.text
+
+
+def iter_pruned_tree(dom_tree, actions: dict):
+    """Walk the pruned tree in document order without building it.
+
+    Yields ("start", node) and ("end", node) for kept elements, and
+    ("other", node) for comments and processing instructions.
+    """
+    stack = [(dom_tree, False)]
+    while stack:
+        node, closing = stack.pop()
+        if closing:
+            yield "end", node
+            continue
+        if not isinstance(node.tag, str):
+            yield "other", node
+            continue
+        action, _ = actions[node]
+        if action == "drop":
+            continue
+        if action == "unwrap":
+            stack.extend([(c, False) for c in reversed(node)])
+            continue
+        yield "start", node
+        stack.append((node, True))
+        stack.extend([(c, False) for c in reversed(node)])
+
+
+def serialize_pruned_tree(
+    dom_tree,
+    actions: dict,
+    candidate_set,
+    max_value_length=5,
+    max_length=20,
+    with_tail: bool = True,
+) -> str:
+    """Serialize the pruned tree as `etree.tostring` would, without building it."""
+    pieces = []
+    for event, node in iter_pruned_tree(dom_tree, actions):
+        if event == "other":
+            pieces.append(etree.tostring(node, encoding="unicode", with_tail=False))
+        elif event == "start":
+            attrib, text = get_node_repr(
+                node, candidate_set, max_value_length, max_length
+            )
+            start_tag = "<" + node.tag + "".join(
+                [f' {k}="{escape_attribute(v)}"' for k, v in attrib]
+            )
+            if text is None and actions[node][1] == 0:
+                pieces.append(start_tag + "/>")
+            else:
+                pieces.append(start_tag + ">")
+                if text is not None:
+                    pieces.append(escape_text(text))
+            continue
+        elif not (node.text is None and actions[node][1] == 0):
+            pieces.append(f"</{node.tag}>")
+        if node.tail is not None and (with_tail or node is not dom_tree):
+            pieces.append(escape_text(node.tail))
+    return "".join(pieces)
+
+
+def emit_tree_tokens(
+    dom_tree,
+    actions: dict,
+    candidate_set,
+    max_value_length=5,
+    max_length=20,
+    keep_html_brackets=False,
+    with_tail: bool = True,
+) -> str | None:
+    """Emit the compact `get_tree_repr` form of the pruned tree token by token.
+
+    Each tag and text is rewritten on its own, and only tokens with characters
+    touched by `clean_tree_repr` go through `clean_token`. Returns None when the
+    tree has content whose rewrites may span tokens (comments, `<text>` nodes
+    with attributes or children, entities or `$` at token ends), in which case
+    the markup has to be cleaned as a whole.
+    """
+    tokens = []
+    for event, node in iter_pruned_tree(dom_tree, actions):
+        if event == "other":
+            return None
+        tag, num_children = node.tag, actions[node][1]
+        if event == "start":
+            attrib, text = get_node_repr(
+                node, candidate_set, max_value_length, max_length
+            )
+            if tag == "text":
+                if attrib or num_children:
+                    return None
+                tokens.append(compact_text(text, keep_html_brackets))
+                continue
+            is_empty = text is None and num_children == 0
+            if any(has_special_chars(v, " /\t\n") for _, v in attrib):
+                markup = "<" + tag + "".join(
+                    [f' {k}="{escape_attribute(v)}"' for k, v in attrib]
+                )
+                markup += "/>" if is_empty else ">"
+                tokens.append(clean_token(markup, keep_html_brackets))
+            else:
+                token = ("<" if keep_html_brackets else "(") + tag
+                token += "".join([f" id={v}" if k == "id" else f" {v}" for k, v in attrib])
+                if is_empty:
+                    if keep_html_brackets:
+                        token += " />" if attrib else "/>"
+                    else:
+                        token += " )" if attrib else ")"
+                elif keep_html_brackets:
+                    token += ">"
+                tokens.append(token)
+            if text is not None:
+                tokens.append(compact_text(text, keep_html_brackets))
+            continue
+        if tag != "text" and not (node.text is None and num_children == 0):
+            tokens.append(f"</{tag}>" if keep_html_brackets else ")")
+        if node.tail is not None and (with_tail or node is not dom_tree):
+            tokens.append(compact_text(node.tail, keep_html_brackets))
+
+    # entities and `$/$` split across two tokens are rewritten by the whole-string pass
+    for token in tokens[:-1]:
+        if ("&" in token[-6:] and token[-1:] not in ">)") or ("$" in token[-2:]):
+            return None
+    return " ".join("".join(tokens).split())
+
+
+def has_special_chars(text: str, extra: str = "") -> bool:
+    """Check if the `clean_tree_repr` rewrites may change the text."""
+    return any([c in text for c in '"&=$\r' + extra])
+
+
+def compact_text(text: str, keep_html_brackets: bool = False) -> str:
+    if has_special_chars(text):
+        return clean_token(escape_text(text), keep_html_brackets)
+    return text
+
+
+def get_pruned_tree_repr(
+    dom_tree,
+    candidate_set,
+    max_depth=5,
+    max_children=50,
+    max_sibling=3,
+    max_value_length=5,
+    max_length=20,
+    keep_html_brackets=False,
+    index: NodeIndex = None,
+    emit_tokens: bool = True,
+    root=None,
+) -> str:
+    """Single-pass version of `get_tree_repr(prune_tree(...))`.
+
+    Walks the original tree read-only, so no copy of the tree is made. With
+    `emit_tokens`, the compact representation is emitted directly; otherwise
+    the pruned tree is serialized as `etree.tostring` would and then cleaned
+    by `clean_tree_repr`, which is the reference for the emitted tokens.
+    If `root` is given, only its subtree (without its tail) is represented.
+    """
+    nodes_to_keep = get_nodes_to_keep(
+        dom_tree, candidate_set, max_depth, max_children, max_sibling, index
+    )
+    with_tail = root is None
+    if root is None:
+        root = dom_tree
+    actions = get_prune_actions(root, candidate_set, nodes_to_keep)
+    if emit_tokens:
+        tree_repr = emit_tree_tokens(
+            root, actions, candidate_set,
+            max_value_length, max_length, keep_html_brackets, with_tail,
+        )
+        if tree_repr is not None:
+            return tree_repr
+    tree_repr = serialize_pruned_tree(
+        root, actions, candidate_set, max_value_length, max_length, with_tail
+    )
+    return clean_tree_repr(tree_repr, keep_html_brackets)
+
+
 def get_tree_repr(
     tree, max_value_length=5, max_length=20, id_mapping={}, keep_html_brackets=False
 ):
@@ -389,6 +969,28 @@ def get_tree_repr(
             node.text = " ".join(node.text.split()[:max_length])
     tree_repr = etree.tostring(tree, encoding="unicode")
 
+    return clean_tree_repr(tree_repr, keep_html_brackets), id_mapping
+
+
+HTML_ESCAPE_TABLE = [
+    ("&quot;", '"'),
+    ("&amp;", "&"),
+    ("&lt;", "<"),
+    ("&gt;", ">"),
+    ("&nbsp;", " "),
+    ("&ndash;", "-"),
+    ("&rsquo;", "'"),
+    ("&lsquo;", "'"),
+    ("&ldquo;", '"'),
+    ("&rdquo;", '"'),
+    ("&#39;", "'"),
+    ("&#40;", "("),
+    ("&#41;", ")"),
+]
+
+
+def clean_tree_repr(tree_repr: str, keep_html_brackets: bool = False) -> str:
+    """Compact the serialized html of a `get_tree_repr` tree."""
     tree_repr = tree_repr.replace('"', " ")
     tree_repr = (
         tree_repr.replace("meta= ", "").replace("id= ", "id=").replace(" >", ">")
@@ -400,23 +1002,22 @@ def get_tree_repr(
         tree_repr = re.sub(r"<(.+?)>", r"(\1", tree_repr)
         tree_repr = tree_repr.replace("$/$", ")")
 
-    html_escape_table = [
-        ("&quot;", '"'),
-        ("&amp;", "&"),
-        ("&lt;", "<"),
-        ("&gt;", ">"),
-        ("&nbsp;", " "),
-        ("&ndash;", "-"),
-        ("&rsquo;", "'"),
-        ("&lsquo;", "'"),
-        ("&ldquo;", '"'),
-        ("&rdquo;", '"'),
-        ("&#39;", "'"),
-        ("&#40;", "("),
-        ("&#41;", ")"),
-    ]
-    for k, v in html_escape_table:
+    for k, v in HTML_ESCAPE_TABLE:
         tree_repr = tree_repr.replace(k, v)
     tree_repr = re.sub(r"\s+", " ", tree_repr).strip()
 
-    return tree_repr, id_mapping
+    return tree_repr
+
+
+def clean_token(token: str, keep_html_brackets: bool = False) -> str:
+    """Apply the `clean_tree_repr` rewrites to a single serialized tag or text."""
+    token = token.replace('"', " ")
+    token = token.replace("meta= ", "").replace("id= ", "id=").replace(" >", ">")
+    if not keep_html_brackets:
+        token = token.replace("/>", "$/$>")
+        token = re.sub(r"</(.+?)>", r")", token)
+        token = re.sub(r"<(.+?)>", r"(\1", token)
+        token = token.replace("$/$", ")")
+    for k, v in HTML_ESCAPE_TABLE:
+        token = token.replace(k, v)
+    return token
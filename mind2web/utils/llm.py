@@ -1,26 +1,265 @@
 import logging
 import re
 import os
+import json
+import time
+import random
+import hashlib
 import inspect
+import functools
+import threading
+import email.utils
 import tiktoken
+from collections import OrderedDict
+from utils.cache import ResponseCache, get_response_key
 
 logger = logging.getLogger("main")
 
 import openai
-openai.api_key = os.environ["OPENAI_API_KEY"]
+openai.api_key = os.environ.get("OPENAI_API_KEY")  # not needed to replay responses
 from openai import OpenAI
-client = OpenAI()
 
 
-def num_tokens_from_messages(messages, model):
-    """Return the number of tokens used by a list of messages.
-    Borrowed from https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+# %% client
+CLIENT_CONFIG = {
+    "max_connections": 16,  # pooled http connections, kept alive across requests
+    "keepalive_expiry": 60.0,  # seconds an idle connection is kept
+    "timeout": 120.0,  # seconds per request
+    "max_retries": 8,  # on rate limits, connection errors, and server errors
+    "backoff_base": 1.0,  # seconds, doubled per retry up to `backoff_max`
+    "backoff_max": 60.0,
+    "rpm": None,  # client-side limits of requests / tokens per minute
+    "tpm": None,
+}
+client = None
+rate_limiter = None
+response_cache: ResponseCache | None = None  # see `set_response_cache`
+
+
+def configure_client(**config):
+    """Update `CLIENT_CONFIG`; the client and limiter are rebuilt on next use."""
+    global client, rate_limiter
+    unknown = set(config) - set(CLIENT_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown client config: {sorted(unknown)}")
+    CLIENT_CONFIG.update(config)
+    client, rate_limiter = None, None
+
+
+def set_response_cache(cache: ResponseCache | None):
+    """Answer repeated requests from `cache` instead of the API."""
+    global response_cache
+    response_cache = cache
+
+
+class ResponseLog:
+    """Record/replay backend: responses logged to a jsonl file, one
+    `{"key", "message", "info", "latency"}` line per request.
+
+    In `record` mode, responses from the API are appended to `path`. In
+    `replay` mode, requests are answered from `path` by key (see
+    `get_response_key`) without network access, optionally after sleeping a
+    latency drawn from the recorded ones (`simulate_latency`).
     """
+
+    def __init__(self, path: str, mode: str, simulate_latency: bool = False, seed: int = 0):
+        if mode not in ["record", "replay"]:
+            raise ValueError(f"Unknown response log mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.simulate_latency = simulate_latency
+        self.rng = random.Random(seed)
+        self.entries, self.latencies = {}, []
+        if mode == "record" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if mode == "replay":
+            with open(path, "r") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries[entry["key"]] = (entry["message"], entry["info"])
+                    self.latencies.append(entry["latency"])
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+
+    def record(self, key: str, message: str, info: dict[str, int], latency: float):
+        entry = {"key": key, "message": message, "info": info, "latency": latency}
+        with self.lock, open(self.path, "a") as fw:
+            fw.write(json.dumps(entry) + "\n")
+
+    def replay(self, key: str) -> tuple[str, dict[str, int]]:
+        if key not in self.entries:
+            self.misses += 1
+            raise KeyError(f"No recorded response for request [{key}] in [{self.path}]")
+        self.hits += 1
+        if self.simulate_latency and self.latencies:
+            time.sleep(self.rng.choice(self.latencies))
+        message, info = self.entries[key]
+        return message, dict(info)
+
+
+response_log: ResponseLog | None = None  # see `set_response_log`
+
+
+def set_response_log(log: ResponseLog | None):
+    """Record API responses to, or replay them from, `log`."""
+    global response_log
+    response_log = log
+
+
+def get_client() -> OpenAI:
+    """Create the client on first use, with a keep-alive connection pool. Retries
+    are done by `generate_response`, so the client itself does not retry."""
+    global client
+    if client is None:
+        import httpx
+
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=CLIENT_CONFIG["max_connections"],
+                max_keepalive_connections=CLIENT_CONFIG["max_connections"],
+                keepalive_expiry=CLIENT_CONFIG["keepalive_expiry"],
+            ),
+            timeout=CLIENT_CONFIG["timeout"],
+        )
+        client = OpenAI(http_client=http_client, max_retries=0)
+    return client
+
+
+class TokenBucket:
+    """Allows `rate` units per minute, in bursts of up to `rate`."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / 60)
+        self.updated = now
+
+    def acquire(self, amount: float):
+        """Wait until `amount` units (at most `rate`) are available, then take them."""
+        amount = min(amount, self.rate)
+        with self.lock:
+            self.refill()
+            while self.tokens < amount:
+                time.sleep((amount - self.tokens) * 60 / self.rate)
+                self.refill()
+            self.tokens -= amount
+
+    def adjust(self, amount: float):
+        """Take (or give back, if negative) units after the fact, e.g., once the
+        actual usage of a request is known. The bucket may go into debt."""
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+
+
+class RateLimiter:
+    """Client-side requests-per-minute and tokens-per-minute limits."""
+
+    def __init__(self, rpm: float = None, tpm: float = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+    def acquire(self, messages: list[dict[str, str]], model: str) -> int:
+        """Wait for a request slot and its estimated prompt tokens; returns the estimate."""
+        if self.requests is not None:
+            self.requests.acquire(1)
+        num_tokens = 0
+        if self.tokens is not None:
+            num_tokens = estimate_num_tokens(messages, model)
+            self.tokens.acquire(num_tokens)
+        return num_tokens
+
+    def settle(self, estimated_tokens: int, info: dict[str, int]):
+        """Charge the difference between the actual and the estimated tokens."""
+        if self.tokens is not None:
+            self.tokens.adjust(info["total_tokens"] - estimated_tokens)
+
+
+def get_rate_limiter() -> RateLimiter:
+    global rate_limiter
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(CLIENT_CONFIG["rpm"], CLIENT_CONFIG["tpm"])
+    return rate_limiter
+
+
+def get_retry_after(error: Exception) -> float | None:
+    """Seconds to wait as requested by the `Retry-After` headers of an error response."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                retry_at = email.utils.parsedate_to_datetime(value).timestamp()
+                return max(0.0, retry_at - time.time())
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, openai.APIConnectionError):  # including timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in [408, 409, 429] or error.status_code >= 500
+    return False
+
+
+def get_backoff_delay(attempt: int, retry_after: float | None = None) -> float:
+    """Full-jitter exponential backoff, but no shorter than `retry_after`."""
+    delay = random.uniform(
+        0, min(CLIENT_CONFIG["backoff_max"], CLIENT_CONFIG["backoff_base"] * 2 ** attempt)
+    )
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
         # print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# token counts of message contents, by encoding and content hash
+TOKEN_COUNTS_SIZE = 1 << 16
+token_counts = OrderedDict()
+
+
+def count_text_tokens(text: str, encoding: tiktoken.Encoding) -> int:
+    """Return the number of tokens of `text`, memoized in a bounded LRU, so
+    contents repeated across steps (system message, workflows, exemplars,
+    earlier trajectory) are encoded once."""
+    key = (encoding.name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+    if key in token_counts:
+        token_counts.move_to_end(key)
+        return token_counts[key]
+    num_tokens = len(encoding.encode(text))
+    token_counts[key] = num_tokens
+    if len(token_counts) > TOKEN_COUNTS_SIZE:
+        token_counts.popitem(last=False)
+    return num_tokens
+
+
+def num_tokens_from_messages(messages, model):
+    """Return the number of tokens used by a list of messages.
+    Borrowed from https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    """
+    encoding = get_encoding(model)
     if model in {
         "GPT-3-5-turbo-chat",
         "GPT-3-5-16k-turbo-chat",
@@ -49,7 +288,7 @@ def num_tokens_from_messages(messages, model):
     for message in messages:
         num_tokens += tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+            num_tokens += count_text_tokens(value, encoding)
             if key == "name":
                 num_tokens += tokens_per_name
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
@@ -70,54 +309,34 @@ MAX_TOKENS = {
 
 
 def get_mode(model: str) -> str:
-    """Check if the model is a chat model."""
+    """Check if the model is a chat model. Models other than the legacy
+    completion ones (e.g., `gpt-4o-mini`) are taken as chat models."""
     if model in [
-        "GPT-3-5-turbo-chat",
-        "GPT-3-5-16k-turbo-chat",
-        "gpt-3.5-16k-turbo-chat",
-        "gpt-3.5-turbo-0301",
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-1106",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-4-0314",
-        "gpt-4-32k-0314",
-        "gpt-4-0613",
-        "gpt-4-32k-0613",
-        "gpt-4",
-        "gpt-4o",
-        "gpt-4-32k-0613",
-    ]:
-        return "chat"
-    elif model in [
         "davinci-002",
         "gpt-3.5-turbo-instruct-0914",
     ]:
         return "completion"
-    else:
-        raise ValueError(f"Unknown model: {model}")
+    return "chat"
 
 
-# @backoff.on_exception(
-#     backoff.constant,
-#     (APIError, RateLimitError, APIConnectionError),
-#     interval=10,
-# )
-def generate_response(
+def estimate_num_tokens(messages: list[dict[str, str]], model: str) -> int:
+    try:
+        return num_tokens_from_messages(messages, model)
+    except NotImplementedError:
+        return sum([len(m["content"]) // 4 + 3 for m in messages]) + 3
+
+
+def request_response(
     messages: list[dict[str, str]],
     model: str,
     temperature: float,
     stop_tokens: list[str] | None = None,
-    use_tools: bool = False,
+    **gen_kwargs,
 ) -> tuple[str, dict[str, int]]:
-    """Send a request to the OpenAI API."""
-
-    logger.info(
-        f"Send a request to the language model from {inspect.stack()[1].function}"
-    )
-    gen_kwargs = {}
+    """Send a single request to the OpenAI API."""
 
     if get_mode(model) == "chat":
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
@@ -132,6 +351,7 @@ def generate_response(
             engine=model,
             temperature=temperature,
             stop=stop_tokens if stop_tokens else None,
+            **gen_kwargs
         )
         message = response["choices"][0]["text"]
     info = {
@@ -144,6 +364,95 @@ def generate_response(
     return message, info
 
 
+def request_with_retries(
+    messages: list[dict[str, str]],
+    model: str,
+    temperature: float,
+    stop_tokens: list[str] | None = None,
+    **gen_kwargs,
+) -> tuple[str, dict[str, int]]:
+    """Send a request within the client-side rate limits, and retry it with
+    backoff on rate limits and transient errors."""
+    rate_limiter = get_rate_limiter()
+    for attempt in range(CLIENT_CONFIG["max_retries"] + 1):
+        estimated_tokens = rate_limiter.acquire(messages, model)
+        try:
+            message, info = request_response(
+                messages, model, temperature, stop_tokens, **gen_kwargs
+            )
+        except (openai.APIConnectionError, openai.APIStatusError) as e:
+            rate_limiter.settle(estimated_tokens, {"total_tokens": 0})
+            if attempt == CLIENT_CONFIG["max_retries"] or not is_retryable(e):
+                raise
+            delay = get_backoff_delay(attempt, get_retry_after(e))
+            logger.warning(
+                f"Request failed ({type(e).__name__}), retrying in {delay:.1f}s "
+                f"[{attempt + 1}/{CLIENT_CONFIG['max_retries']}]"
+            )
+            time.sleep(delay)
+            continue
+        rate_limiter.settle(estimated_tokens, info)
+        return message, info
+
+
+def request_backend(
+    messages: list[dict[str, str]],
+    model: str,
+    temperature: float,
+    stop_tokens: list[str] | None = None,
+    **gen_kwargs,
+) -> tuple[str, dict[str, int]]:
+    """Get a response from the API, recording it if a record log is set, or
+    from the replay log if set."""
+    if response_log is None:
+        return request_with_retries(messages, model, temperature, stop_tokens, **gen_kwargs)
+    key = get_response_key(model, messages, temperature, stop_tokens, **gen_kwargs)
+    if response_log.mode == "replay":
+        return response_log.replay(key)
+    start = time.perf_counter()
+    message, info = request_with_retries(messages, model, temperature, stop_tokens, **gen_kwargs)
+    response_log.record(key, message, info, time.perf_counter() - start)
+    return message, info
+
+
+def generate_response(
+    messages: list[dict[str, str]],
+    model: str,
+    temperature: float,
+    stop_tokens: list[str] | None = None,
+    use_tools: bool = False,
+    max_tokens: int | None = None,
+) -> tuple[str, dict[str, int]]:
+    """Send a request to the OpenAI API (or the record/replay backend, see
+    `set_response_log`), unless answered by the response cache.
+
+    With a cache, the returned token counts are those billed (zero on a hit),
+    plus `cache_hits`, `cache_misses`, and `saved_prompt_tokens`.
+    """
+
+    logger.info(
+        f"Send a request to the language model from {inspect.stack()[1].function}"
+    )
+    gen_kwargs = {}
+    if max_tokens is not None:
+        gen_kwargs["max_tokens"] = max_tokens
+    if response_cache is None:
+        return request_backend(messages, model, temperature, stop_tokens, **gen_kwargs)
+
+    key = get_response_key(model, messages, temperature, stop_tokens, **gen_kwargs)
+    cached = response_cache.get(key)
+    if cached is not None:
+        message, info = cached
+        return message, {
+            "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0,
+            "cache_hits": 1, "cache_misses": 0,
+            "saved_prompt_tokens": info["prompt_tokens"],
+        }
+    message, info = request_backend(messages, model, temperature, stop_tokens, **gen_kwargs)
+    response_cache.put(key, message, info)
+    return message, {**info, "cache_hits": 0, "cache_misses": 1, "saved_prompt_tokens": 0}
+
+
 def extract_from_response(response: str, backtick="```") -> str:
     if backtick == "```":
         # Matches anything between ```<optional label>\n and \n```
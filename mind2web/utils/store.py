@@ -0,0 +1,139 @@
+import os
+import json
+import mmap
+from utils.data import get_data_paths, get_shard_stat
+
+
+# %% observation store
+# bump after changing how step observations are built, to invalidate existing stores
+STORE_VERSION = 1
+
+
+class ObservationStore:
+    """Precomputed step observations of a benchmark split (or of one website).
+
+    Records are stored as json lines in `{name}.jsonl`, and `{name}.index.json`
+    maps each step key (`{annotation_id}_{action_uid}`) to the byte offset and
+    length of its record, next to the fingerprint of the inputs it was built
+    from. The data file is memory-mapped, and a record is only decoded when its
+    step is requested.
+    """
+
+    def __init__(self, data_path: str, index: dict):
+        self.index = index["records"]
+        self.file = open(data_path, "rb")
+        self.data = None
+        if os.path.getsize(data_path) > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def get(self, key: str) -> dict | None:
+        if key not in self.index:
+            return None
+        offset, length = self.index[key]
+        return json.loads(self.data[offset: offset + length])
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+        self.file.close()
+
+
+def get_store_paths(
+    store_dir: str, benchmark: str, top_k: int, previous_top_k: int,
+    website: str = None,
+) -> tuple[str, str]:
+    """Get the data and index paths of the observation store of a split or website."""
+    name = benchmark if website is None else f"{benchmark}_{website}"
+    name = f"{name}_top{top_k}_prev{previous_top_k}"
+    return (
+        os.path.join(store_dir, f"{name}.jsonl"),
+        os.path.join(store_dir, f"{name}.index.json"),
+    )
+
+
+def get_store_fingerprint(
+    data_dir: str, benchmark: str, top_k: int, previous_top_k: int,
+    website: str = None, score_path: str = "data/scores_all_data.pkl",
+    score_store_dir: str = "data/scores",
+) -> dict:
+    """Identify the inputs of a store: the split shards and candidate scores
+    (by size and mtime), the observation parameters, and `STORE_VERSION`."""
+    score_paths = [score_path, os.path.join(score_store_dir, "keys.npy")]
+    return {
+        "version": STORE_VERSION,
+        "shards": {
+            os.path.basename(p): get_shard_stat(p)
+            for p in get_data_paths(data_dir, benchmark)
+        },
+        "scores": [get_shard_stat(p) if os.path.exists(p) else None for p in score_paths],
+        "top_k": top_k,
+        "previous_top_k": previous_top_k,
+        "website": website,
+    }
+
+
+def open_store(
+    store_dir: str, data_dir: str, benchmark: str, top_k: int, previous_top_k: int,
+    website: str = None,
+) -> ObservationStore | None:
+    """Open the observation store of a website, or else of its split, if it has
+    been precomputed from the current data and scores."""
+    for store_website in dict.fromkeys([website, None]):
+        data_path, index_path = get_store_paths(
+            store_dir, benchmark, top_k, previous_top_k, store_website
+        )
+        if not (os.path.exists(data_path) and os.path.exists(index_path)):
+            continue
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        fingerprint = get_store_fingerprint(
+            data_dir, benchmark, top_k, previous_top_k, store_website
+        )
+        if (
+            index.get("fingerprint") != fingerprint
+            or index.get("data_size") != os.path.getsize(data_path)
+        ):
+            print(f"Observation store [{index_path}] is outdated, ignoring it")
+            continue
+        return ObservationStore(data_path, index)
+    return None
+
+
+def write_store(
+    records, store_dir: str, data_dir: str, benchmark: str, top_k: int,
+    previous_top_k: int, website: str = None,
+) -> int:
+    """Write (key, record) pairs into the observation store of a split or website.
+
+    Both files are written to temporary paths and then moved in place; the
+    index records the data file size, so a data file without its own index is
+    not read.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    data_path, index_path = get_store_paths(
+        store_dir, benchmark, top_k, previous_top_k, website
+    )
+    fingerprint = get_store_fingerprint(data_dir, benchmark, top_k, previous_top_k, website)
+    tmp_data_path, tmp_index_path = [f"{p}.{os.getpid()}.tmp" for p in [data_path, index_path]]
+    index, offset = {}, 0
+    with open(tmp_data_path, "wb") as fw:
+        for key, record in records:
+            line = (json.dumps(record) + "\n").encode("utf-8")
+            fw.write(line)
+            index[key] = [offset, len(line)]
+            offset += len(line)
+    with open(tmp_index_path, "w") as fw:
+        json.dump({"fingerprint": fingerprint, "data_size": offset, "records": index}, fw)
+    os.replace(tmp_data_path, data_path)
+    os.replace(tmp_index_path, index_path)
+    return len(index)
+
+
+def get_step_key(sample: dict, step: dict) -> str:
+    return f"{sample['annotation_id']}_{step['action_uid']}"